@@ -1,6 +1,7 @@
 """A bot to controll settings for tgcf live mode."""
 
 import logging
+from typing import Optional
 
 import yaml
 from telethon import events
@@ -14,6 +15,8 @@ from tgcf.bot.utils import (
     remove_source,
 )
 from tgcf.config import CONFIG, write_config
+from tgcf.deadletter import dead_letters, format_letter
+from tgcf.limiter import limiter
 from tgcf.plugin_models import Style
 
 
@@ -46,7 +49,9 @@ async def forward_command_handler(event):
         except:
             pass
         CONFIG.forwards.append(forward)
-        config.from_to = await config.load_from_to(event.client, config.CONFIG.forwards)
+        config.from_to = await config.load_from_to(
+            config.agent_of(event.client), event.client, config.CONFIG.forwards
+        )
 
         await event.respond("Success")
         write_config(config.CONFIG)
@@ -78,7 +83,9 @@ async def remove_command_handler(event):
         parsed_args = yaml.safe_load(args)
         source_to_remove = parsed_args.get("source")
         CONFIG.forwards = remove_source(source_to_remove, config.CONFIG.forwards)
-        config.from_to = await config.load_from_to(event.client, config.CONFIG.forwards)
+        config.from_to = await config.load_from_to(
+            config.agent_of(event.client), event.client, config.CONFIG.forwards
+        )
 
         await event.respond("Success")
         write_config(config.CONFIG)
@@ -121,6 +128,57 @@ async def style_command_handler(event):
         raise events.StopPropagation
 
 
+@admin_protect
+async def rates_command_handler(event):
+    """Handle the /rates command."""
+    try:
+        rates = limiter.rates()
+        if not rates:
+            await event.respond("Nothing has been sent yet")
+            return
+        lines = ["Current rates (messages per second)"]
+        for (agent_id, dest), (rate, paused) in rates.items():
+            line = f"agent {agent_id} -> {dest}: {rate:.2f}"
+            if paused:
+                line += f" (flood wait, {paused:.0f}s left)"
+            lines.append(line)
+        await event.respond("\n".join(lines))
+
+    finally:
+        raise events.StopPropagation
+
+
+@admin_protect
+async def dlq_command_handler(event):
+    """Handle the /dlq command."""
+    notes = """The `/dlq` command shows the sends that failed and will be retried.
+
+    `/dlq` lists them, `/dlq retry` retries all of them now,
+    `/dlq clear` drops all of them.
+    """.replace(
+        "    ", ""
+    )
+    try:
+        agent_id = config.agent_of(event.client)
+        args = get_args(event.message.text)
+        if args == "retry":
+            count = dead_letters.retry_now(agent_id)
+            await event.respond(f"{count} letters will be retried")
+        elif args == "clear":
+            count = dead_letters.clear(agent_id)
+            await event.respond(f"Dropped {count} letters")
+        elif args:
+            await event.respond(notes)
+        else:
+            waiting, parked = dead_letters.count(agent_id)
+            lines = [f"{waiting} waiting, {parked} parked"]
+            lines += [format_letter(letter) for letter in dead_letters.get(agent_id)]
+            await event.respond("\n".join(lines))
+
+    finally:
+        raise events.StopPropagation
+
+
 async def start_command_handler(event):
     """Handle the /start command."""
     await event.respond(CONFIG.bot_messages.start)
@@ -131,14 +189,16 @@ async def help_command_handler(event):
     await event.respond(CONFIG.bot_messages.bot_help)
 
 
-def get_events():
-    _ = get_command_prefix()
+def get_events(is_bot: Optional[bool] = None):
+    _ = get_command_prefix(is_bot)
     logging.info(f"Command prefix is . for userbot and / for bot")
     command_events = {
         "start": (start_command_handler, events.NewMessage(pattern=f"{_}start")),
         "forward": (forward_command_handler, events.NewMessage(pattern=f"{_}forward")),
         "remove": (remove_command_handler, events.NewMessage(pattern=f"{_}remove")),
         "style": (style_command_handler, events.NewMessage(pattern=f"{_}style")),
+        "rates": (rates_command_handler, events.NewMessage(pattern=f"{_}rates")),
+        "dlq": (dlq_command_handler, events.NewMessage(pattern=f"{_}dlq")),
         "help": (help_command_handler, events.NewMessage(pattern=f"{_}help")),
     }
 
@@ -1,6 +1,6 @@
 """helper functions for the bot."""
 import logging
-from typing import List
+from typing import List, Optional
 
 from telethon import events
 
@@ -60,7 +60,9 @@ def remove_source(source, forwards: List[Forward]) -> List[Forward]:
     raise ValueError("The source does not exist")
 
 
-def get_command_prefix():
-    if config.is_bot is None:
+def get_command_prefix(is_bot: Optional[bool] = None):
+    if is_bot is None:
+        is_bot = config.is_bot
+    if is_bot is None:
         raise ValueError("config.is_bot is not set!")
-    return "/" if config.is_bot else "\."
+    return "/" if is_bot else "\."
@@ -0,0 +1,132 @@
+"""Track the offsets of forwards without rewriting the whole config per message.
+
+Offsets are kept in a small json file per agent, which is written in the
+background every few seconds or after many updates. On a clean shutdown the
+offsets are folded back into the config.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Set
+
+from tgcf import storage as stg
+from tgcf.config import Forward, read_config, write_config
+from tgcf.const import CHECKPOINT_EVERY, CHECKPOINT_FILE_NAME, CHECKPOINT_INTERVAL
+
+
+class Checkpoints:
+    """Collect offset updates and flush them to disk with atomic renames."""
+
+    def __init__(
+        self,
+        file_name: str = CHECKPOINT_FILE_NAME,
+        interval: float = CHECKPOINT_INTERVAL,
+        every: int = CHECKPOINT_EVERY,
+    ) -> None:
+        self.file_name = file_name
+        self.interval = interval
+        self.every = every
+        self.offsets: Dict[int, Dict[str, int]] = {}
+        self.dirty: Set[int] = set()
+        self.updated: Set[int] = set()
+        self.pending = 0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def path(self, agent_id: int) -> str:
+        return self.file_name.format(agent_id)
+
+    def load(self, agent_id: int) -> Dict[str, int]:
+        """Return the saved offsets of an agent, reading its file once."""
+        if agent_id not in self.offsets:
+            try:
+                with open(self.path(agent_id), encoding="utf8") as file:
+                    self.offsets[agent_id] = json.load(file)
+            except FileNotFoundError:
+                self.offsets[agent_id] = {}
+            except (OSError, ValueError) as err:
+                logging.warning(f"Could not read {self.path(agent_id)}: {err}")
+                self.offsets[agent_id] = {}
+        return self.offsets[agent_id]
+
+    def restore(self, forwards: List[Forward]) -> None:
+        """Apply offsets left behind by a run that did not shut down cleanly."""
+        for forward in forwards:
+            offset = self.load(forward.agent).get(str(forward.source), 0)
+            if offset > forward.offset:
+                logging.info(f"Restored offset {offset} for {forward.source}")
+                forward.offset = offset
+
+    def update(self, forward: Forward, offset: int) -> None:
+        """Set the offset of a forward, it is written to disk later."""
+        forward.offset = offset
+        self.load(forward.agent)[str(forward.source)] = offset
+        self.dirty.add(forward.agent)
+        self.updated.add(forward.agent)
+        self.pending += 1
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        if self.pending >= self.every:
+            self.wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except OSError as err:
+                logging.error(f"Failed to write checkpoint: {err}")
+
+    async def flush(self) -> None:
+        """Write the offsets of all agents that changed since the last flush."""
+        dirty, self.dirty, self.pending = self.dirty, set(), 0
+        for agent_id in dirty:
+            data = json.dumps(self.offsets[agent_id])
+            await asyncio.to_thread(self._write, self.path(agent_id), data)
+
+    @staticmethod
+    def _write(path: str, data: str) -> None:
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf8") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+
+    async def close(self) -> None:
+        """Stop flushing in the background and save the offsets in the config."""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.dirty |= self.updated
+        await self.flush()
+        if not self.updated:
+            return
+
+        # other agents may run in other processes, only touch our own offsets
+        config = read_config()
+        for forward in config.forwards:
+            if forward.agent in self.updated:
+                offsets = self.offsets[forward.agent]
+                forward.offset = offsets.get(str(forward.source), forward.offset)
+        write_config(config, persist=False)
+        if stg.CONFIG_TYPE == 2:
+            # offsets are not persisted to mongo, keep the files
+            return
+        for agent_id in self.updated:
+            try:
+                os.remove(self.path(agent_id))
+            except FileNotFoundError:
+                pass
+        self.updated.clear()
+
+
+checkpoints = Checkpoints()
@@ -3,9 +3,10 @@
 import asyncio
 import logging
 import os
+import signal
 import sys
 from enum import Enum
-from typing import Optional
+from typing import List, Optional
 
 import typer
 from dotenv import load_dotenv
@@ -30,11 +31,12 @@ def topper():
 
 
 class Mode(str, Enum):
-    """tgcf works in two modes."""
+    """tgcf works in two modes, multi runs many agents in their own modes."""
 
     PAST = "past"
     LIVE = "live"
     BOTH = "both"
+    MULTI = "multi"
 
 
 def verbosity_callback(value: bool):
@@ -86,6 +88,17 @@ def main(
     agent_id: Optional[int] = typer.Argument(
         default=0, help="Choose the agent to use for message forwarding."
     ),
+    agents: Optional[List[int]] = typer.Option(
+        None,
+        "--agent",
+        "-a",
+        help="Agents to run in multi mode, can be repeated. All agents by default.",
+    ),
+    fresh: bool = typer.Option(
+        False,
+        "--fresh",
+        help="Delete saved sessions first, every agent logs in again.",
+    ),
     verbose: Optional[bool] = typer.Option(  # pylint: disable=unused-argument
         None,
         "--loud",
@@ -114,6 +127,21 @@ def main(
         logging.critical(f"You are running fake with {mode} mode")
         sys.exit(1)
 
+    if fresh:
+        from tgcf.utils import clean_session_files  # pylint: disable=import-outside-toplevel
+
+        clean_session_files()
+    # let a termination signal unwind like ctrl+c, so pending offsets get saved
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if mode == Mode.MULTI:
+        from tgcf.config import CONFIG  # pylint: disable=import-outside-toplevel
+        from tgcf.multi import run_agents  # pylint: disable=import-outside-toplevel
+
+        agent_ids = agents or list(range(len(CONFIG.login_cfg.agents)))
+        logging.info(f"Running agent ids: {agent_ids}")
+        asyncio.run(run_agents(agent_ids))
+        return
+
     logging.info(f"Running agent id: {agent_id}")
     if mode == Mode.PAST:
         from tgcf.past import forward_job  # pylint: disable=import-outside-toplevel
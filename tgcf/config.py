@@ -1,18 +1,20 @@
 """Load all user defined config and env vars."""
 
+import asyncio
 import logging
 import os
 import sys
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from dotenv import load_dotenv
 from pydantic import BaseModel, validator  # pylint: disable=no-name-in-module
 from pymongo import MongoClient
 from telethon import TelegramClient
-from telethon.sessions import StringSession
+from telethon.sessions import SQLiteSession, StringSession
 
 from tgcf import storage as stg
-from tgcf.const import CONFIG_FILE_NAME
+from tgcf.const import CONFIG_FILE_NAME, RESOLVE_CONCURRENCY, SESSION_DIR
+from tgcf.peers import peers
 from tgcf.plugin_models import PluginConfig
 
 pwd = os.getcwd()
@@ -42,7 +44,20 @@ class LiveSettings(BaseModel):
     # pylint: disable=too-few-public-methods
     sequential_updates: bool = True
     delete_sync: bool = False
+    edit_sync: bool = True
+    edit_wait: float = 3.0  # seconds to collect edits of a message before syncing
     delete_on_edit: Optional[str] = ".deleteMe"
+    queue_size: int = 100  # max pending messages per source chat
+    album_wait: float = 1.0  # seconds a chat stays quiet before its album is sent
+    overflow: str = "block"  # when a chat queue is full: block, drop_oldest or spill
+
+    @validator("overflow")
+    def validate_overflow(cls, val):  # pylint: disable=no-self-use,no-self-argument
+        """Fall back to blocking for an unknown overflow policy."""
+        if val not in ("block", "drop_oldest", "spill"):
+            logging.warning(f"Unknown overflow policy {val}, using block")
+            val = "block"
+        return val
 
 
 class PastSettings(BaseModel):
@@ -50,6 +65,8 @@ class PastSettings(BaseModel):
 
     # pylint: disable=too-few-public-methods
     delay: int = 0
+    concurrency: int = 5  # sources backfilled at the same time
+    plugin_workers: int = 4  # messages of a source the plugins work on at once
 
     @validator("delay")
     def validate_delay(cls, val):  # pylint: disable=no-self-use,no-self-argument
@@ -97,6 +114,9 @@ class AgentForwardingConfig(BaseModel):
     live: LiveSettings = LiveSettings()
     past: PastSettings = PastSettings()
     pid:int = 0
+    max_parallel_sends: int = 10  # destinations sent to at the same time
+    rate_limit: float = 1.0  # requests per second to one destination
+    burst: int = 5  # requests to one destination allowed back to back
 
 
 class LoginConfig(BaseModel):
@@ -194,6 +214,49 @@ async def get_id(client: TelegramClient, peer):
     return await client.get_peer_id(peer)
 
 
+def numeric_id(peer: Union[int, str]) -> Optional[int]:
+    """Return the id of a peer given as a number, None if it must be resolved."""
+    if isinstance(peer, int):
+        return peer
+    peer = peer.strip()
+    if peer.lstrip("-").isdigit():
+        return int(peer)
+    return None
+
+
+async def resolve_peers(
+    client: TelegramClient,
+    chats: List[Union[int, str]],
+    limit: int = RESOLVE_CONCURRENCY,
+) -> Dict[Union[int, str], int]:
+    """Resolve many peers to chat ids, each distinct peer only once.
+
+    Numeric ids are used as they are, the others are resolved concurrently,
+    at most limit at a time.
+    """
+    ids: Dict[Union[int, str], int] = {}
+    pending = []
+    for peer in dict.fromkeys(chats):
+        num = numeric_id(peer)
+        if num is None:
+            pending.append(peer)
+        else:
+            ids[peer] = num
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def resolve(peer):
+        async with semaphore:
+            return await get_id(client, peer.strip())
+
+    resolved = await asyncio.gather(*(resolve(peer) for peer in pending))
+    ids.update(zip(pending, resolved))
+    logging.info(
+        f"Resolved {len(ids)} peers, {len(pending)} of them over the network"
+    )
+    return ids
+
+
 async def load_active_forwards(agent_id: int, forwards: List[Forward]) -> List[Forward]:
     active_forwards: List[Forward] = []
     for forward in forwards:
@@ -205,31 +268,16 @@ async def load_active_forwards(agent_id: int, forwards: List[Forward]) -> List[F
     return active_forwards
 
 
-async def load_working_forwards(agent_id: int, forwards: List[Forward], chat_id) -> Forward | None:
-    working_forwards: List[Forward] = []
-    for forward in forwards:
-        if forward.agent != agent_id:
-            continue
-        if not forward.use_this:
-            continue
-        if chat_id != forward.source:
-            continue
-        working_forwards.append(forward)
-    if len(working_forwards) == 0:
-        logging.error("Error: Not forward matched!")
-        return None
-    elif len(working_forwards) > 1:
-        logging.error("Error: More than one forward matched!")
-        return None
-    else:
-        return working_forwards[0]
+def get_route(agent_id: int, chat_id: int) -> Optional[Dict[str, Any]]:
+    """Return the route of a source chat for an agent, built by load_from_to."""
+    return routes.get((agent_id, chat_id))
 
 
 async def load_from_to(
     agent_id: int,
     client: TelegramClient,
     forwards: List[Forward],
-) -> Dict[int, Dict[str, List[int] | int]]:
+) -> Dict[int, Dict[str, Any]]:
     """Convert a list of Forward objects to a mapping.
     The active connections of current agent are included.
 
@@ -242,41 +290,60 @@ async def load_from_to(
                 value = dict
                 dest: List of chat ids of destinations
                 pcgf: id of plugin config to use
+                forward: the Forward object itself
 
     Notes:
     -> The Forward objects may contain username/phn no/links
     -> But this mapping strictly contains signed integer chat ids
     -> Chat ids are essential for how storage is implemented
     -> Storage is essential for edit, delete and reply syncs
+    -> The routes of the agent are replaced by this mapping, see get_route
     """
     from_to_dict: dict = {}
-
-    async def _(peer):
-        return await get_id(client, peer)
+    forwards = [
+        forward
+        for forward in forwards
+        if forward.agent == agent_id
+        and forward.use_this
+        and (isinstance(forward.source, int) or forward.source.strip() != "")
+    ]
+    chats = [chat for forward in forwards for chat in [forward.source, *forward.dest]]
+    ids = await resolve_peers(client, chats)
 
     for forward in forwards:
-        if forward.agent != agent_id:
-            continue
-        if not forward.use_this:
-            continue
-        source = forward.source
-        if not isinstance(source, int) and source.strip() == "":
-            continue
-        src = await _(forward.source)
+        src = ids[forward.source]
         # from_to_dict[src] = {
         #     "dest": [], # the list of destination entities
         #     "pcfg": 0 # id of the plugin config to use
         # }
         from_to_dict[src] = {}
-        from_to_dict[src]["dest"] = [await _(dest) for dest in forward.dest]
+        from_to_dict[src]["dest"] = [ids[dest] for dest in forward.dest]
         from_to_dict[src]["pcfg"] = forward.plugin_cfg
+        from_to_dict[src]["forward"] = forward
     logging.info(f"From to dict is {from_to_dict}")
+    await peers.load(
+        client, [dest for route in from_to_dict.values() for dest in route["dest"]]
+    )
+
+    for key in [key for key in routes if key[0] == agent_id]:
+        del routes[key]
+    routes.update({(agent_id, src): route for src, route in from_to_dict.items()})
+    clients[agent_id] = client
     return from_to_dict
 
 
+def agent_of(client: TelegramClient) -> int:
+    """Return the id of the agent logged in with client."""
+    for agent_id, agent_client in clients.items():
+        if agent_client is client:
+            return agent_id
+    raise ValueError("The client does not belong to any agent")
+
+
 async def load_admins(client: TelegramClient):
-    for admin in CONFIG.admins:
-        ADMINS.append(await get_id(client, admin))
+    # replaced in place, agents sharing a process resolve the same admins
+    ids = await resolve_peers(client, CONFIG.admins)
+    ADMINS[:] = [ids[admin] for admin in CONFIG.admins]
     logging.info(f"Loaded admins are {ADMINS}")
     return ADMINS
 
@@ -315,22 +382,64 @@ if PASSWORD == "tgcf":
     logging.warn(
         "You have not set a password to protect the web access to tgcf.\nThe default password `tgcf` is used."
     )
-from_to: Dict[int, Dict[str, int | List[int]]] = {}
+from_to: Dict[int, Dict[str, Any]] = {}
+# (agent id, source chat id) -> value of the from_to mapping of that agent
+routes: Dict[Tuple[int, int], Dict[str, Any]] = {}
+clients: Dict[int, TelegramClient] = {}
 is_bot: Optional[bool] = None
 logging.info("config.py got executed")
 
 
+def user_session(agent_id: int, session_string: str) -> SQLiteSession:
+    """Return the session file of a user agent, seeded from its session string.
+
+    Unlike a string session, the file keeps telethon's entity cache between
+    runs. It is started afresh when the session string belongs to another login.
+    """
+    string = StringSession(session_string)
+    path = os.path.join(SESSION_DIR, f"tgcf_user{agent_id}")
+    session = SQLiteSession(path)
+    if session.auth_key != string.auth_key:
+        if session.auth_key is not None:
+            logging.info(f"Session string of agent {agent_id} changed")
+            # cached access hashes are only valid for the old login
+            session.close()
+            session.delete()
+            session = SQLiteSession(path)
+        session.set_dc(string.dc_id, string.server_address, string.port)
+        session.auth_key = string.auth_key
+        session.save()
+    return session
+
+
+def bot_session(agent_id: int, bot_token: str, name: str = "tgcf_bot") -> str:
+    """Return the path of the session file of a bot agent.
+
+    The file is named after the bot id in the token, so a token of another
+    bot starts a new session. Files of bots the agent used before are removed.
+    """
+    prefix = f"{name}{agent_id}"
+    current = f"{prefix}_{bot_token.split(':')[0].strip()}"
+    for item in os.listdir(SESSION_DIR):
+        stem = item.split(".session")[0]
+        if stem != current and (stem == prefix or stem.startswith(f"{prefix}_")):
+            logging.info(f"Bot token of agent {agent_id} changed, removing {item}")
+            os.remove(os.path.join(SESSION_DIR, item))
+    return os.path.join(SESSION_DIR, current)
+
+
 def get_SESSION(
     agent_id: int, login_cfg: LoginConfig = CONFIG.login_cfg, default: str = "tgcf_bot"
 ):
     # TODO: validate agent_id
     agent = login_cfg.agents[agent_id]
+    os.makedirs(SESSION_DIR, exist_ok=True)
     if agent.SESSION_STRING and agent.user_type == 1:
         logging.info("using session string")
-        SESSION = StringSession(agent.SESSION_STRING)
+        SESSION = user_session(agent_id, agent.SESSION_STRING)
     elif agent.BOT_TOKEN and agent.user_type == 0:
         logging.info("using bot account")
-        SESSION = default + str(agent_id)
+        SESSION = bot_session(agent_id, agent.BOT_TOKEN, default)
     else:
         logging.warning("Login information not set!")
         sys.exit()
@@ -4,6 +4,8 @@ COMMANDS = {
     "start": "Check whether I am alive",
     "forward": "Set a new forward",
     "remove": "Remove an existing forward",
+    "rates": "Show the current sending rates",
+    "dlq": "List, retry or clear failed sends",
     "help": "Learn usage",
 }
 
@@ -11,8 +13,49 @@ REGISTER_COMMANDS = True
 
 KEEP_LAST_MANY = 10000
 
+MESSAGE_MAP_FILE_NAME = "tgcf.messages.db"
+MESSAGE_MAP_BATCH = 200  # write mappings after this many are pending
+MESSAGE_MAP_INTERVAL = 2  # or after this many seconds
+
+DELETE_CHUNK = 100  # max message ids telegram accepts in one delete request
+
+FLOOD_RETRIES = 3  # times a request is retried after a flood wait
+
+DEAD_LETTER_FILE_NAME = "tgcf.deadletters.db"
+DEAD_LETTER_RETRIES = 8  # attempts before a failed send is parked
+DEAD_LETTER_BACKOFF = 30  # seconds, doubled on every attempt
+DEAD_LETTER_MAX_BACKOFF = 3600
+DEAD_LETTER_POLL = 10  # seconds between looking for due retries
+
+RESOLVE_CONCURRENCY = 10  # peers resolved at the same time on startup
+
+SESSION_DIR = "tgcf.sessions"  # telethon session files, one per agent
+
 CONFIG_FILE_NAME = "tgcf.config.json"
 CONFIG_ENV_VAR_NAME = "TGCF_CONFIG"
 
+CHECKPOINT_FILE_NAME = "tgcf.offsets.{}.json"  # formatted with the agent id
+CHECKPOINT_INTERVAL = 5  # seconds between background flushes
+CHECKPOINT_EVERY = 100  # flush early after this many offset updates
+# ids an offset can be behind the copies after a crash, CHECKPOINT_EVERY batches
+CHECKPOINT_LAG = 10000
+
+PAST_PROGRESS_EVERY = 100  # log backfill progress after this many messages
+PAST_PIPELINE_SIZE = 50  # messages read ahead of the one being sent
+BULK_FORWARD_SIZE = 100  # max messages telegram forwards in one request
+PAST_CHUNK_SIZE = 5000  # ids per range of history read by one reader
+PAST_READERS = 4  # ranges of one source read at the same time
+PAST_READ_AHEAD = 1000  # messages each reader buffers before its range is due
+
+JOURNAL_DIR = "tgcf.journal.{}"  # spilled messages, formatted with the agent id
+JOURNAL_RETRY = 5  # seconds before loading spilled messages again after an error
+
+MEDIA_MEMORY_LIMIT = 8 * 1024 * 1024  # bytes, larger media is spooled to disk
+MEDIA_MEMORY_BUDGET = 128 * 1024 * 1024  # bytes of media kept in memory at once
+SPOOL_DIR = "tgcf.spool"  # large media for plugins, in the temp directory
+SPOOL_ENV_VAR_NAME = "TGCF_SPOOL_DIR"  # to put the spool on faster storage
+SPOOL_MAX_SIZE = 2 * 1024 * 1024 * 1024  # bytes the spooled files may take
+SPOOL_WAIT = 60  # seconds to wait for room in a full spool
+
 MONGO_DB_NAME = "tgcf-config"
 MONGO_COL_NAME = "tgcf-instance-0"
@@ -0,0 +1,250 @@
+"""Keep sends that failed for a transient reason, and retry them later.
+
+A failed send is stored in sqlite with the source chat, the source message
+ids, the destination and the plugin config. A scheduler running next to the
+live workers retries due letters with exponential backoff and jitter. After
+DEAD_LETTER_RETRIES attempts a letter is parked until it is retried by hand.
+"""
+
+import asyncio
+import logging
+import random
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from telethon import TelegramClient
+from telethon.errors import RpcCallFailError, ServerError, TimedOutError
+from telethon.errors.rpcerrorlist import FloodWaitError
+from telethon.tl.custom.message import Message
+
+from tgcf import storage as st
+from tgcf.const import (
+    DEAD_LETTER_BACKOFF,
+    DEAD_LETTER_FILE_NAME,
+    DEAD_LETTER_MAX_BACKOFF,
+    DEAD_LETTER_POLL,
+    DEAD_LETTER_RETRIES,
+)
+from tgcf.plugins import _apply_plugins
+from tgcf.utils import send_message
+
+TRANSIENT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    FloodWaitError,
+    ServerError,
+    TimedOutError,
+    RpcCallFailError,
+)
+
+Letter = Tuple[int, int, int, List[int], int, int, int, Optional[float], str]
+
+
+def is_transient(err: BaseException) -> bool:
+    """Tell whether a send may succeed when it is tried again later."""
+    return isinstance(err, TRANSIENT_ERRORS)
+
+
+def backoff(attempts: int) -> float:
+    """Return the seconds to wait before the next attempt, with full jitter."""
+    cap = min(DEAD_LETTER_MAX_BACKOFF, DEAD_LETTER_BACKOFF * 2**attempts)
+    return random.uniform(0, cap)
+
+
+def format_letter(letter: Letter) -> str:
+    """Describe a letter in one line."""
+    letter_id, agent_id, chat, msg_ids, dest, _, attempts, next_try, error = letter
+    if next_try is None:
+        when = "parked"
+    else:
+        when = f"next try in {max(0, next_try - time.time()):.0f}s"
+    return (
+        f"#{letter_id} agent {agent_id}: {chat} {msg_ids} -> {dest},"
+        f" {attempts} attempts, {when}, {error}"
+    )
+
+
+class DeadLetters:
+    """Failed sends, persisted in sqlite."""
+
+    def __init__(self, path: str = DEAD_LETTER_FILE_NAME) -> None:
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS letters (
+                    id INTEGER PRIMARY KEY,
+                    agent INTEGER, chat INTEGER, msg_ids TEXT,
+                    dest INTEGER, pcfg INTEGER,
+                    attempts INTEGER, next_try REAL, error TEXT,
+                    UNIQUE (agent, chat, msg_ids, dest)
+                )"""
+            )
+        return self.conn
+
+    def add(
+        self,
+        agent_id: int,
+        pcfg_id: int,
+        messages: Iterable[Message],
+        failed: Dict[int, Exception],
+    ) -> None:
+        """Store the destinations a message could not be sent to.
+
+        Only transient errors are kept, the others would fail again.
+        """
+        messages = list(messages)
+        if not messages:
+            return
+        chat = messages[0].chat_id
+        msg_ids = " ".join(str(message.id) for message in messages)
+        next_try = time.time() + backoff(0)
+        rows = [
+            (agent_id, chat, msg_ids, dest, pcfg_id, next_try, repr(err))
+            for dest, err in failed.items()
+            if is_transient(err)
+        ]
+        if not rows:
+            return
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO letters"
+                " (agent, chat, msg_ids, dest, pcfg, attempts, next_try, error)"
+                " VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                rows,
+            )
+        logging.warning(f"Kept {len(rows)} failed sends of {chat} {msg_ids} for retry")
+
+    def _letters(self, where: str, args: tuple, limit: int) -> List[Letter]:
+        rows = self.db.execute(
+            "SELECT id, agent, chat, msg_ids, dest, pcfg, attempts, next_try, error"
+            f" FROM letters WHERE {where} ORDER BY id LIMIT ?",
+            (*args, limit),
+        ).fetchall()
+        return [
+            (i, agent, chat, [int(m) for m in msg_ids.split()], dest, pcfg, *rest)
+            for i, agent, chat, msg_ids, dest, pcfg, *rest in rows
+        ]
+
+    def due(self, agent_id: int, limit: int = 50) -> List[Letter]:
+        """Return the letters of an agent whose next attempt is due."""
+        return self._letters(
+            "agent = ? AND next_try <= ?", (agent_id, time.time()), limit
+        )
+
+    def get(self, agent_id: Optional[int] = None, limit: int = 20) -> List[Letter]:
+        """Return the oldest letters, of one agent or of all."""
+        if agent_id is None:
+            return self._letters("1", (), limit)
+        return self._letters("agent = ?", (agent_id,), limit)
+
+    def count(self, agent_id: Optional[int] = None) -> Tuple[int, int]:
+        """Return how many letters are waiting and how many were parked."""
+        query = "SELECT COUNT(next_try), COUNT(*) - COUNT(next_try) FROM letters"
+        if agent_id is None:
+            return self.db.execute(query).fetchone()
+        return self.db.execute(f"{query} WHERE agent = ?", (agent_id,)).fetchone()
+
+    def remove(self, letter_id: int) -> None:
+        with self.db:
+            self.db.execute("DELETE FROM letters WHERE id = ?", (letter_id,))
+
+    def retry_later(self, letter_id: int, attempts: int, err: Exception) -> None:
+        """Schedule the next attempt, or park the letter after too many."""
+        attempts += 1
+        next_try = None
+        if attempts < DEAD_LETTER_RETRIES:
+            next_try = time.time() + backoff(attempts)
+        with self.db:
+            self.db.execute(
+                "UPDATE letters SET attempts = ?, next_try = ?, error = ? WHERE id = ?",
+                (attempts, next_try, repr(err), letter_id),
+            )
+
+    def retry_now(self, agent_id: Optional[int] = None) -> int:
+        """Make all letters due again, parked ones included."""
+        query = "UPDATE letters SET attempts = 0, next_try = ?"
+        args: tuple = (time.time(),)
+        if agent_id is not None:
+            query += " WHERE agent = ?"
+            args += (agent_id,)
+        with self.db:
+            return self.db.execute(query, args).rowcount
+
+    def clear(self, agent_id: Optional[int] = None) -> int:
+        with self.db:
+            if agent_id is None:
+                return self.db.execute("DELETE FROM letters").rowcount
+            return self.db.execute(
+                "DELETE FROM letters WHERE agent = ?", (agent_id,)
+            ).rowcount
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def retry(self, client: TelegramClient, letter: Letter) -> None:
+        """Send a letter again, it is removed once it got through."""
+        letter_id, agent_id, chat, msg_ids, dest, pcfg_id, attempts, *_ = letter
+        messages = [m for m in await client.get_messages(chat, ids=msg_ids) if m]
+        tm = None
+        for message in messages:
+            ntm = await _apply_plugins(pcfg_id, message)
+            if tm is None:
+                tm = ntm
+                if tm and message.grouped_id:
+                    tm.add_grouped_file(message)
+            elif ntm:
+                tm.add_grouped_file(message)
+                tm.add_text(ntm.text)
+                # only the text of a later part is used
+                ntm.clear()
+        if tm is None:
+            # the messages were deleted, or the plugins filter them now
+            self.remove(letter_id)
+            return
+        try:
+            reply_to = None
+            first = tm.get_first_message()
+            if first.is_reply:
+                replies = st.stored.first_ids(
+                    st.EventUid(st.DummyEvent(chat, first.reply_to_msg_id))
+                )
+                reply_to = replies.get(dest)
+            fwded = await send_message(agent_id, dest, tm, reply_to=reply_to)
+        except Exception as err:
+            logging.warning(f"Retry of {chat} {msg_ids} to {dest} failed: {err}")
+            if is_transient(err):
+                self.retry_later(letter_id, attempts, err)
+            else:
+                self.retry_later(letter_id, DEAD_LETTER_RETRIES, err)
+        else:
+            st.remember(tm.grouped_files or [tm.message], {dest: fwded})
+            self.remove(letter_id)
+            logging.info(f"Retry of {chat} {msg_ids} to {dest} succeeded")
+        finally:
+            tm.clear()
+
+    async def retry_due(self, agent_id: int, client: TelegramClient) -> None:
+        """Retry the letters of an agent that are due now."""
+        try:
+            for letter in self.due(agent_id):
+                await self.retry(client, letter)
+        except Exception as err:
+            logging.exception(f"Failed to retry dead letters: {err}")
+
+    async def run(self, agent_id: int, client: TelegramClient) -> None:
+        """Retry the due letters of an agent, until cancelled."""
+        while True:
+            await self.retry_due(agent_id, client)
+            await asyncio.sleep(DEAD_LETTER_POLL)
+
+
+dead_letters = DeadLetters()
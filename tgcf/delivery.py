@@ -0,0 +1,60 @@
+"""Send messages to the destinations of their forward and record the outcome.
+
+The copies go into the message map, the failed sends into the dead letters
+and the new offset into the checkpoints. close_stores saves all three.
+"""
+
+import logging
+from typing import Any, Dict
+
+from telethon.tl.custom.message import Message
+
+from tgcf import storage as st
+from tgcf.checkpoint import checkpoints
+from tgcf.deadletter import dead_letters
+from tgcf.plugins import TgcfMessage
+from tgcf.utils import send_to_all
+
+
+async def deliver(
+    agent_id: int, route: Dict[str, Any], tm: TgcfMessage
+) -> Dict[int, Message]:
+    """Send a message or album to all destinations and move the offset past it.
+
+    A reply is sent as a reply to the copy of the message it replies to.
+    Destinations that got a copy just before a crash are skipped.
+
+    Returns:
+        Dict: the copies, keyed by destination
+    """
+    fwded_msgs: Dict[int, Message] = {}
+    message = tm.get_first_message()
+    if message:
+        copied = st.stored.earlier_copies(
+            st.EventUid(message), route["forward"].offset
+        )
+        dest = [d for d in route["dest"] if d not in copied]
+        if len(dest) < len(route["dest"]):
+            logging.info(
+                f"Message {message.id} of {message.chat_id} was copied before,"
+                f" sending it to {dest} only"
+            )
+        replies = {}
+        if message.is_reply:
+            r_event = st.DummyEvent(message.chat_id, message.reply_to_msg_id)
+            replies = st.stored.first_ids(st.EventUid(r_event))
+        fwded_msgs, failed = await send_to_all(agent_id, dest, tm, replies)
+        originals = tm.grouped_files or [tm.message]
+        st.remember(originals, fwded_msgs)
+        dead_letters.add(agent_id, route["pcfg"], originals, failed)
+    if message or not tm.get_next():
+        # an empty head ends at the id of the message after it, if any
+        checkpoints.update(route["forward"], tm.get_last_id())
+    return fwded_msgs
+
+
+async def close_stores() -> None:
+    """Save the offsets and close the message map and the dead letters."""
+    await checkpoints.close()
+    st.stored.close()
+    dead_letters.close()
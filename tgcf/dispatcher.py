@@ -0,0 +1,240 @@
+"""Per-source queues that decouple receiving updates from forwarding them."""
+
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from tgcf.const import JOURNAL_RETRY
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+SPILL = "spill"
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+
+class Journal:
+    """Append-only files of lines, one per chat, read back from the start.
+
+    Lines stay pending after they were read, until they are marked as done.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.positions: Dict[int, int] = {}
+        self.counts: Dict[int, int] = {}
+
+    def path(self, key: int) -> str:
+        return os.path.join(self.directory, f"{key}.journal")
+
+    def pending(self, key: int) -> int:
+        """Return the number of lines not done yet."""
+        if key not in self.counts:
+            try:
+                with open(self.path(key), encoding="utf8") as file:
+                    self.counts[key] = sum(1 for _ in file)
+            except FileNotFoundError:
+                self.counts[key] = 0
+        return self.counts[key]
+
+    def append(self, key: int, line: str) -> None:
+        self.pending(key)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(key), "a", encoding="utf8") as file:
+            file.write(line + "\n")
+        self.counts[key] += 1
+
+    def read(self, key: int, count: int) -> Tuple[List[str], int]:
+        """Read the next pending lines, at most count of them.
+
+        Returns:
+            Tuple: the lines, and the position after them to pass to done
+        """
+        lines = []
+        with open(self.path(key), encoding="utf8") as file:
+            file.seek(self.positions.get(key, 0))
+            while len(lines) < count:
+                line = file.readline()
+                if not line:
+                    break
+                lines.append(line.rstrip("\n"))
+            end = file.tell()
+        return lines, end
+
+    def done(self, key: int, end: int, count: int) -> None:
+        """Mark the count lines read up to end as handled."""
+        self.positions[key] = end
+        self.counts[key] = max(0, self.pending(key) - count)
+
+    def compact(self, key: int, head: List[str]) -> None:
+        """Rewrite a journal with head followed by the lines not done yet."""
+        rest = self.read(key, self.pending(key))[0] if self.pending(key) else []
+        lines = head + rest
+        if not lines:
+            self.clear(key)
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f"{self.path(key)}.tmp"
+        with open(tmp, "w", encoding="utf8") as file:
+            file.write("".join(line + "\n" for line in lines))
+        os.replace(tmp, self.path(key))
+        self.positions.pop(key, None)
+        self.counts[key] = len(lines)
+
+    def clear(self, key: int) -> None:
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+        self.positions.pop(key, None)
+        self.counts.pop(key, None)
+
+
+class Dispatcher:
+    """Distribute items on bounded per-key queues, each drained by its own worker.
+
+    Items sharing a key are handled one after another, in the order they were put.
+    Items with different keys are handled concurrently.
+    If on_idle is given, it is called with the key whenever its queue stayed
+    empty for idle_timeout seconds.
+
+    The overflow policy decides what happens to an item put on a full queue.
+    With block, put waits for a free slot. With drop_oldest, the oldest queued
+    item is dropped. With spill, the item is dumped to a line in the journal,
+    and so is every later item until the worker has loaded and handled them all.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable[None]],
+        maxsize: int = 100,
+        on_idle: Optional[Callable[[Hashable], Awaitable[None]]] = None,
+        idle_timeout: Optional[float] = None,
+        overflow: str = BLOCK,
+        journal: Optional[Journal] = None,
+        dump: Callable[[Any], str] = str,
+        load: Optional[Callable[[Hashable, List[str]], Awaitable[List[Any]]]] = None,
+    ) -> None:
+        self.handler = handler
+        self.maxsize = maxsize
+        self.on_idle = on_idle
+        self.idle_timeout = idle_timeout if on_idle else None
+        self.overflow = overflow
+        self.journal = journal
+        self.dump = dump
+        self.load = load
+        self.queues: Dict[Hashable, asyncio.Queue] = {}
+        self.workers: Dict[Hashable, asyncio.Task] = {}
+        # the item taken off the queue of a key that is being handled
+        self.handling: Dict[Hashable, Any] = {}
+
+    def _queue(self, key: Hashable) -> asyncio.Queue:
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = asyncio.Queue(self.maxsize)
+            self.queues[key] = queue
+            self.workers[key] = asyncio.create_task(self._work(key, queue))
+        return queue
+
+    def spilled(self, key: Hashable) -> int:
+        """Return the number of items of key waiting in the journal."""
+        return self.journal.pending(key) if self.journal else 0
+
+    def resume(self, key: Hashable) -> None:
+        """Start the worker of key if items were left in its journal."""
+        if self.spilled(key):
+            logging.info(f"Replaying {self.spilled(key)} spilled items for {key}")
+            self._queue(key)
+
+    def discard_spilled(self, key: Hashable) -> None:
+        """Forget the items of key waiting in the journal."""
+        if self.spilled(key):
+            logging.info(f"Discarding {self.spilled(key)} spilled items for {key}")
+            self.journal.clear(key)
+
+    async def put(self, key: Hashable, item: Any) -> None:
+        """Queue an item, applying the overflow policy if the queue of key is full."""
+        queue = self._queue(key)
+        if self.overflow == SPILL and (self.spilled(key) or queue.full()):
+            if not self.spilled(key):
+                logging.warning(f"Queue for {key} is full, spilling to disk")
+            self.journal.append(key, self.dump(item))
+            return
+        if queue.full():
+            if self.overflow == DROP_OLDEST:
+                queue.get_nowait()
+                queue.task_done()
+                logging.warning(f"Queue for {key} is full, dropped the oldest item")
+            else:
+                logging.warning(f"Queue for {key} is full, waiting for a free slot")
+        await queue.put(item)
+
+    async def _replay(self, key: Hashable) -> None:
+        """Handle the next spilled items, they stay in the journal until then."""
+        lines, end = self.journal.read(key, self.maxsize)
+        try:
+            items = await self.load(key, lines)
+        except Exception as err:
+            logging.exception(
+                f"Worker for {key} failed to load spilled items,"
+                f" retrying in {JOURNAL_RETRY}s: {err}"
+            )
+            await asyncio.sleep(JOURNAL_RETRY)
+            return
+        for item in items:
+            try:
+                await self.handler(item)
+            except Exception as err:
+                logging.exception(f"Worker for {key} failed to handle an item: {err}")
+        self.journal.done(key, end, len(lines))
+        if not self.spilled(key):
+            # nothing was spilled while these were handled
+            self.journal.clear(key)
+            logging.info(f"Replayed all spilled items for {key}")
+
+    async def _work(self, key: Hashable, queue: asyncio.Queue) -> None:
+        while True:
+            if queue.empty() and self.spilled(key):
+                await self._replay(key)
+                continue
+            try:
+                item = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                try:
+                    await self.on_idle(key)
+                except Exception as err:
+                    logging.exception(f"Worker for {key} failed when idle: {err}")
+                continue
+            self.handling[key] = item
+            try:
+                await self.handler(item)
+            except Exception as err:
+                logging.exception(f"Worker for {key} failed to handle an item: {err}")
+            # kept when cancelled, for stop to save it
+            del self.handling[key]
+            queue.task_done()
+
+    def depth(self, key: Hashable) -> int:
+        """Return the number of items waiting for key, in memory or on disk."""
+        queue = self.queues.get(key)
+        return (queue.qsize() if queue else 0) + self.spilled(key)
+
+    async def stop(self) -> None:
+        """Cancel all workers.
+
+        Items still queued are dropped, unless there is a journal. Then they
+        are saved in front of the spilled items, to be replayed on resume. So
+        is an item whose handling was cancelled, and spilled items stay in the
+        journal until they were handled. The handler has to skip items it
+        handled before.
+        """
+        for worker in self.workers.values():
+            worker.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        if self.journal:
+            for key, queue in self.queues.items():
+                items = [self.handling.pop(key)] if key in self.handling else []
+                items += [queue.get_nowait() for _ in range(queue.qsize())]
+                self.journal.compact(key, [self.dump(item) for item in items])
+        self.workers.clear()
+        self.queues.clear()
@@ -0,0 +1,41 @@
+"""The command line interface for the dead letters of tgcf.
+
+A running live mode retries due letters by itself, these commands only look
+at the store and reschedule or drop letters.
+"""
+
+from typing import Optional
+
+import typer
+from rich import console
+
+from tgcf.deadletter import dead_letters, format_letter
+
+app = typer.Typer(add_completion=False, help="Inspect the sends tgcf will retry.")
+con = console.Console()
+
+AGENT = typer.Option(None, "--agent", "-a", help="Only the letters of this agent.")
+
+
+@app.command("list")
+def list_letters(
+    agent_id: Optional[int] = AGENT,
+    limit: int = typer.Option(20, "--limit", "-n", help="Show at most this many."),
+):
+    """Show the oldest failed sends."""
+    waiting, parked = dead_letters.count(agent_id)
+    con.print(f"{waiting} waiting, {parked} parked")
+    for letter in dead_letters.get(agent_id, limit):
+        con.print(format_letter(letter), highlight=False)
+
+
+@app.command()
+def retry(agent_id: Optional[int] = AGENT):
+    """Make all failed sends due now, parked ones included."""
+    con.print(f"{dead_letters.retry_now(agent_id)} letters will be retried")
+
+
+@app.command()
+def clear(agent_id: Optional[int] = AGENT):
+    """Drop failed sends without retrying them."""
+    con.print(f"Dropped {dead_letters.clear(agent_id)} letters")
@@ -0,0 +1,116 @@
+"""Pace outbound requests with token buckets, one per agent and destination.
+
+A bucket refills at its current rate, up to its burst size. When telegram
+answers with a flood wait, only the bucket of that destination is paused and
+its rate is halved. Every successful request raises the rate again a little,
+up to the configured rate.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from telethon.errors.rpcerrorlist import FloodWaitError
+
+from tgcf.config import CONFIG
+from tgcf.const import FLOOD_RETRIES
+
+
+class Bucket:
+    """Tokens available for requests to one destination."""
+
+    __slots__ = (
+        "max_rate",
+        "rate",
+        "burst",
+        "tokens",
+        "updated",
+        "paused_until",
+        "lock",
+    )
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = asyncio.get_running_loop().time()
+        self.paused_until = 0.0
+        # waiters get their tokens in the order they asked for them
+        self.lock = asyncio.Lock()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter:
+    def __init__(self) -> None:
+        self.buckets: Dict[Tuple[int, Hashable], Bucket] = {}
+
+    def bucket(self, agent_id: int, dest: Hashable) -> Bucket:
+        key = (agent_id, dest)
+        if key not in self.buckets:
+            cfg = CONFIG.agent_fwd_cfg[agent_id]
+            self.buckets[key] = Bucket(cfg.rate_limit, cfg.burst)
+        return self.buckets[key]
+
+    async def acquire(self, agent_id: int, dest: Hashable) -> None:
+        """Wait until a request to dest is allowed."""
+        bucket = self.bucket(agent_id, dest)
+        loop = asyncio.get_running_loop()
+        async with bucket.lock:
+            while True:
+                now = loop.time()
+                if bucket.paused_until > now:
+                    await asyncio.sleep(bucket.paused_until - now)
+                    continue
+                bucket.refill(now)
+                if bucket.tokens >= 1:
+                    bucket.tokens -= 1
+                    return
+                await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+
+    def flood(self, agent_id: int, dest: Hashable, seconds: int) -> None:
+        """Pause a destination for a flood wait and slow it down."""
+        bucket = self.bucket(agent_id, dest)
+        now = asyncio.get_running_loop().time()
+        bucket.paused_until = max(bucket.paused_until, now + seconds)
+        bucket.rate = max(bucket.max_rate / 16, bucket.rate / 2)
+        bucket.tokens = 0
+        bucket.updated = now + seconds
+        logging.warning(
+            f"Flood wait of {seconds}s for {dest}, rate lowered to {bucket.rate:.3f}/s"
+        )
+
+    def success(self, agent_id: int, dest: Hashable) -> None:
+        """Raise the rate of a destination again after a successful request."""
+        bucket = self.bucket(agent_id, dest)
+        bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate / 20)
+
+    async def call(
+        self, agent_id: int, dest: Hashable, func: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """Make a request to dest when allowed, retrying it after flood waits."""
+        for attempt in range(FLOOD_RETRIES + 1):
+            await self.acquire(agent_id, dest)
+            try:
+                result = await func()
+            except FloodWaitError as fwe:
+                self.flood(agent_id, dest, fwe.seconds)
+                if attempt == FLOOD_RETRIES:
+                    raise
+                continue
+            self.success(agent_id, dest)
+            return result
+
+    def rates(self) -> Dict[Tuple[int, Hashable], Tuple[float, float]]:
+        """Return the current rate and remaining pause of every destination."""
+        now = asyncio.get_running_loop().time()
+        return {
+            key: (bucket.rate, max(0.0, bucket.paused_until - now))
+            for key, bucket in self.buckets.items()
+        }
+
+
+limiter = RateLimiter()
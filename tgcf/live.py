@@ -1,9 +1,12 @@
 """The module responsible for operating tgcf in live mode."""
 
+import asyncio
 import logging
 import os
 import sys
-from typing import Union
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Set, Tuple, Union
 
 from telethon import TelegramClient, events, functions, types
 from telethon.sessions import StringSession
@@ -12,12 +15,27 @@ from telethon.tl.custom.message import Message
 from tgcf import config, const
 from tgcf import storage as st
 from tgcf.bot import get_events
-from tgcf.config import CONFIG, get_SESSION, write_config
-from tgcf.plugins import apply_plugins, load_async_plugins
-from tgcf.utils import clean_session_files, send_message
+from tgcf.checkpoint import checkpoints
+from tgcf.config import CONFIG, get_SESSION
+from tgcf.deadletter import dead_letters
+from tgcf.delivery import close_stores, deliver
+from tgcf.dispatcher import Dispatcher, Journal
+from tgcf.past import backfill, run_backfills
+from tgcf.plugins import _apply_plugins, apply_plugins, load_async_plugins
+from tgcf.utils import delete_messages, edit_message, fan_out, timed
 
 current_agent: int = 0
 
+
+class Edit:
+    """The last edit of a message, queued behind the messages of its chat."""
+
+    __slots__ = ("message",)
+
+    def __init__(self, message: Message) -> None:
+        self.message = message
+
+
 class EventHandler:
     def __init__(self, agent_id: int):
         self.agent_id = agent_id
@@ -25,9 +43,26 @@ class EventHandler:
         self.tm = {k: None for k in self.from_to.keys()}
         self.ALL_EVENTS = {
     "new": (self.new_message_handler, events.NewMessage()),
-    # "edited": (self.edited_message_handler, events.MessageEdited()),
+    "edited": (self.edited_message_handler, events.MessageEdited()),
     "deleted": (self.deleted_message_handler, events.MessageDeleted()),
 }
+        self.edits: Dict[Tuple[int, int], Message] = {}
+        self.edit_tasks: Set[asyncio.Task] = set()
+        self.rendered: OrderedDict[st.EventUid, Dict[int, str]] = OrderedDict()
+        # live messages of the chats being caught up on
+        self.buffers: Dict[int, List[Union[Message, Edit]]] = {}
+        live = CONFIG.agent_fwd_cfg[agent_id].live
+        self.dispatcher = Dispatcher(
+            self.process_message,
+            live.queue_size,
+            on_idle=self.flush,
+            idle_timeout=live.album_wait,
+            overflow=live.overflow,
+            journal=Journal(const.JOURNAL_DIR.format(agent_id)),
+            dump=self.dump_spilled,
+            load=self.load_spilled,
+        )
+
     def get_all_events(self):
         return self.ALL_EVENTS
     
@@ -38,165 +73,274 @@ class EventHandler:
                 new_from_to_keys.append(key)
         self.tm.update({k: None for k in new_from_to_keys})
         self.from_to.update(from_to)
+        for key in new_from_to_keys:
+            self.dispatcher.resume(key)
+
+    async def catch_up(
+        self,
+        src: int,
+        route: Dict[str, Any],
+        fill: Callable[[int, Dict[str, Any]], Awaitable[int]],
+    ) -> None:
+        """Forward what a source missed since its offset, then go live for it.
+
+        New messages of the source are buffered while fill forwards its
+        history. Then the buffered ones fill did not reach are queued, before
+        any later message.
+        """
+        forward: config.Forward = route["forward"]
+        self.buffers[src] = []
+        # the history has the messages spilled by the last run
+        self.dispatcher.discard_spilled(src)
+        self.update_from_to({src: route})
+        try:
+            await fill(src, route)
+        except Exception as err:
+            logging.exception(
+                f"Catching up on {src} failed after id {forward.offset}: {err}"
+            )
+        buffer = self.buffers[src]
+        while buffer:
+            item = buffer.pop(0)
+            if isinstance(item, Edit) or item.id > forward.offset:
+                await self.dispatcher.put(src, item)
+        del self.buffers[src]
+        logging.info(f"Caught up on {src} at id {forward.offset}, now live")
 
     def update_events(self, command_events):
         self.ALL_EVENTS.update(command_events)
 
     async def finish(self):
-        for chat_id in self.tm.keys():
-            dest = self.from_to.get(chat_id).get("dest")
-            pcfg_id = self.from_to.get(chat_id).get("pcfg")
-            if not self.tm[chat_id]:
-                return
-            for d in dest:
-                fwded_msg = await send_message(self.agent_id, d, self.tm[chat_id])
-            self.tm[chat_id].clear()
-            self.tm[chat_id] = self.tm[chat_id].get_next()
-    
+        """Send everything still waiting in any chat."""
+        await self.dispatcher.stop()
+        for chat_id in list(self.tm.keys()):
+            await self.flush(chat_id)
+
+    async def flush(self, chat_id: int) -> None:
+        """Send what waits in a chat, without waiting for its next message."""
+        try:
+            while self.tm.get(chat_id):
+                await self.send_pending(chat_id)
+        except Exception as e:
+            logging.info(f"send message error {e}")
+            self.drop_pending(chat_id)
+
+    def drop_pending(self, chat_id: int) -> None:
+        """Drop what waits in a chat and free its files."""
+        tm = self.tm.get(chat_id)
+        if tm:
+            tm.clear_chain()
+        self.tm[chat_id] = None
+
+    async def send_pending(self, chat_id: int) -> None:
+        """Send the oldest message or album waiting in a chat."""
+        tm = self.tm[chat_id]
+        route = config.get_route(self.agent_id, chat_id)
+        if not route:
+            self.drop_pending(chat_id)
+            return
+        message = tm.get_first_message()
+        fwded_msgs = await deliver(self.agent_id, route, tm)
+        if message and not tm.grouped_files:
+            self.remember_text(st.EventUid(tm.message), tm.text, fwded_msgs)
+        tm.clear()
+        self.tm[chat_id] = tm.get_next()
+
     async def new_message_handler(self, event: Union[Message, events.NewMessage]) -> None:
-        """Process new incoming messages."""
+        """Queue new incoming messages on the worker of their chat."""
         chat_id = event.chat_id
         if chat_id not in self.from_to:
             return
-        logging.info(f"New message received in {chat_id}")
-        message = event.message
-    
-        # event_uid = st.EventUid(event)
-    
-        # length = len(st.stored)
-        # exceeding = length - const.KEEP_LAST_MANY
-    
-        # if exceeding > 0:
-        #     for key in st.stored:
-        #         del st.stored[key]
-        #         break
-        working_forwards = await config.load_working_forwards(
-            self.agent_id, config.CONFIG.forwards, chat_id
+        if chat_id in self.buffers:
+            self.buffers[chat_id].append(event.message)
+            return
+        await self.dispatcher.put(chat_id, event.message)
+        logging.info(
+            f"New message received in {chat_id}, {self.dispatcher.depth(chat_id)} queued"
         )
-        dest = self.from_to.get(chat_id).get("dest")
-        pcfg_id = self.from_to.get(chat_id).get("pcfg")
+
+    @staticmethod
+    def dump_spilled(item: Union[Message, Edit]) -> str:
+        if isinstance(item, Edit):
+            return f"edit {item.message.id}"
+        return str(item.id)
+
+    async def load_spilled(
+        self, chat_id: int, lines: List[str]
+    ) -> List[Union[Message, Edit]]:
+        """Fetch the messages whose ids were spilled to the journal of a chat."""
+        client: TelegramClient = config.clients[self.agent_id]
+        ids = [int(line.split()[-1]) for line in lines]
+        messages = await client.get_messages(chat_id, ids=ids)
+        # messages deleted in the meantime come back as None
+        return [
+            Edit(message) if line.startswith("edit") else message
+            for line, message in zip(lines, messages)
+            if message
+        ]
+
+    async def process_message(self, item: Union[Message, Edit]) -> None:
+        """Process a new message or an edit, called by the worker of its chat."""
+        if isinstance(item, Edit):
+            # the copy of an album still waiting has to be sent before
+            await self.flush(item.message.chat_id)
+            await self.apply_edit(item.message)
+            return
+        message = item
+        chat_id = message.chat_id
+        route = config.get_route(self.agent_id, chat_id)
+        if not route:
+            return
+        if message.id <= route["forward"].offset:
+            # already forwarded, by a catch up or before a restart
+            return
 
         try:
-            self.tm[chat_id] = await apply_plugins(pcfg_id, message, self.tm[chat_id])
-            if not self.tm[chat_id]:
-                return
-            if not self.tm[chat_id].get_next():
-                return
-            
-            if self.tm[chat_id].get_first_message():
-        
-                # if event.is_reply:
-                #     r_event = st.DummyEvent(chat_id, event.reply_to_msg_id)
-                #     r_event_uid = st.EventUid(r_event)
-            
-                # st.stored[event_uid] = {}
-                for d in dest:
-                    # if event.is_reply and r_event_uid in st.stored:
-                    #     self.tm[chat_id].reply_to = st.stored.get(r_event_uid).get(d)
-                    fwded_msg = await send_message(self.agent_id, d, self.tm[chat_id])
-                    # if isinstance(fwded_msg, list):
-                    #     for fm in fwded_msg:
-                    #         st.stored[event_uid].update({d: fwded_msg})
-                    # else:
-                    #     st.stored[event_uid].update({d: fwded_msg})
-            if working_forwards:
-                working_forwards.offset = self.tm[chat_id].get_last_id()
-                write_config(CONFIG, persist=False)
-            self.tm[chat_id].clear()
-            self.tm[chat_id] = self.tm[chat_id].get_next()
-            
+            self.tm[chat_id] = await apply_plugins(
+                route["pcfg"], message, self.tm[chat_id]
+            )
+            if self.tm[chat_id].get_next():
+                await self.send_pending(chat_id)
         except Exception as e:
             logging.info(f"send message error {e}")
-            self.tm[chat_id] = None
-    
-    
+            self.drop_pending(chat_id)
+
+        # an album can not continue after a message that is not part of it
+        if not message.grouped_id:
+            await self.flush(chat_id)
+
+
     async def edited_message_handler(self, event) -> None:
-        """Handle message edits."""
-        message = event.message
-    
+        """Collect message edits, only the last one in a window gets synced."""
         chat_id = event.chat_id
-    
+
         if chat_id not in self.from_to:
             return
-    
+
         logging.info(f"Message edited in {chat_id}")
-    
-        event_uid = st.EventUid(event)
-        pcfg_id = config.self.get(chat_id).get("pcfg")
-    
-        tm = await apply_plugins(pcfg_id, message)
-    
-        if not tm:
+
+        key = (chat_id, event.message.id)
+        if key not in self.edits:
+            task = asyncio.create_task(self.sync_edit(key))
+            self.edit_tasks.add(task)
+            task.add_done_callback(self.edit_tasks.discard)
+        self.edits[key] = event.message
+
+    async def sync_edit(self, key: Tuple[int, int]) -> None:
+        """Queue the latest edit of a message once its debounce window is over.
+
+        It goes behind the messages of its chat, so it is applied after the
+        copy of the message was sent.
+        """
+        await asyncio.sleep(CONFIG.agent_fwd_cfg[self.agent_id].live.edit_wait)
+        message = self.edits.pop(key)
+        chat_id = key[0]
+        if chat_id in self.buffers:
+            self.buffers[chat_id].append(Edit(message))
             return
-    
+        await self.dispatcher.put(chat_id, Edit(message))
+
+    async def apply_edit(self, message: Message) -> None:
+        """Handle message edits, on the copies of the message sent before."""
+        chat_id = message.chat_id
+        route = config.get_route(self.agent_id, chat_id)
+        if not route:
+            return
+
+        event_uid = st.EventUid(message)
         fwded_msgs = st.stored.get(event_uid)
-    
-        if fwded_msgs:
-            for _, msg in fwded_msgs.items():
-                if (
-                    config.CONFIG.agent_fwd_cfg[self.agent_id].live.delete_on_edit
-                    == message.text
-                ):
-                    await msg.delete()
-                    await message.delete()
-                else:
-                    await msg.edit(tm.text)
+        if not fwded_msgs:
+            # never sent, filtered out or sent before the message map existed
+            logging.info(f"No copy of {event_uid} is known, not syncing the edit")
             return
-    
-        dest = self.from_to.get(chat_id).get("dest")
-    
-        for d in dest:
-            await send_message(self.agent_id, d, tm)
+
+        if (
+            config.CONFIG.agent_fwd_cfg[self.agent_id].live.delete_on_edit
+            == message.text
+        ):
+            st.stored.pop(event_uid)
+            self.rendered.pop(event_uid, None)
+            await fan_out(
+                self.agent_id,
+                list(fwded_msgs),
+                lambda d: delete_messages(
+                    self.agent_id, message.client, d, fwded_msgs[d]
+                ),
+            )
+            await message.delete()
+            return
+
+        tm = await _apply_plugins(route["pcfg"], message)
+
+        if not tm:
+            return
+
+        rendered = self.rendered.get(event_uid, {})
+        changed = [d for d in fwded_msgs if rendered.get(d) != tm.text]
+        if not changed:
+            logging.info(f"Text of {event_uid} did not change, not editing")
+            tm.clear()
+            return
+        edited, _ = await fan_out(
+            self.agent_id,
+            changed,
+            lambda d: edit_message(
+                self.agent_id, tm.client, d, fwded_msgs[d][0], tm.text
+            ),
+        )
+        self.remember_text(event_uid, tm.text, edited)
         tm.clear()
-    
-    
+
+    def remember_text(self, event_uid: st.EventUid, text: str, dests) -> None:
+        """Remember the text last sent to the destinations, to skip no-op edits."""
+        rendered = self.rendered.pop(event_uid, {})
+        rendered.update({d: text for d in dests})
+        self.rendered[event_uid] = rendered
+        if len(self.rendered) > const.KEEP_LAST_MANY:
+            self.rendered.popitem(last=False)
+
     async def deleted_message_handler(self, event):
-        """Handle message deletes."""
+        """Handle message deletes, with one request per destination."""
         chat_id = event.chat_id
         if chat_id not in self.from_to:
             return
-    
-        logging.info(f"Message deleted in {chat_id}")
-    
-        event_uid = st.EventUid(event)
-        fwded_msgs = st.stored.get(event_uid)
-        if fwded_msgs:
-            for _, msg in fwded_msgs.items():
-                await msg.delete()
-            return
 
+        logging.info(f"{len(event.deleted_ids)} messages deleted in {chat_id}")
 
-async def start_sync(agent_id: int) -> None:
-    """Start tgcf live sync."""
-    # clear past session files
-    clean_session_files()
-    global current_agent
-    current_agent = agent_id
-    logging.getLogger("telethon").setLevel(logging.WARNING)
-    
-    # load async plugins defined in plugin_models
-    await load_async_plugins()
+        event_uids = [
+            st.EventUid(st.DummyEvent(chat_id, msg_id)) for msg_id in event.deleted_ids
+        ]
+        fwded_ids: Dict[int, List[int]] = {}
+        for event_uid, fwded_msgs in zip(event_uids, st.stored.pop_many(event_uids)):
+            self.rendered.pop(event_uid, None)
+            for d, ids in (fwded_msgs or {}).items():
+                fwded_ids.setdefault(d, []).extend(ids)
+        if not fwded_ids:
+            return
+        await fan_out(
+            self.agent_id,
+            list(fwded_ids),
+            lambda d: delete_messages(self.agent_id, event.client, d, fwded_ids[d]),
+        )
 
-    SESSION = get_SESSION(agent_id)
-    client = TelegramClient(
-        SESSION,
-        CONFIG.login_cfg.tg.API_ID,
-        CONFIG.login_cfg.tg.API_HASH,
-        sequential_updates=CONFIG.agent_fwd_cfg[agent_id].live.sequential_updates,
-    )
+
+async def login(agent_id: int, client: TelegramClient) -> EventHandler:
+    """Start the client of an agent and register its event handlers."""
     agent = CONFIG.login_cfg.agents[agent_id]
-    if agent.user_type == 0:
-        if agent.BOT_TOKEN == "":
-            logging.warning("Bot token not found, but login type is set to bot.")
-            sys.exit()
-        await client.start(bot_token=agent.BOT_TOKEN)
-    else:
-        await client.start()
-    config.is_bot = await client.is_bot()
-    logging.info(f"config.is_bot={config.is_bot}")
-    command_events = get_events()
-
-    await config.load_admins(client)
+    with timed(f"Agent {agent_id}: login"):
+        if agent.user_type == 0:
+            if agent.BOT_TOKEN == "":
+                logging.warning("Bot token not found, but login type is set to bot.")
+                sys.exit()
+            await client.start(bot_token=agent.BOT_TOKEN)
+        else:
+            await client.start()
+        is_bot = config.is_bot = await client.is_bot()
+    logging.info(f"agent {agent_id} is_bot={is_bot}")
+    command_events = get_events(is_bot)
+
+    with timed(f"Agent {agent_id}: loading admins"):
+        await config.load_admins(client)
     eh = EventHandler(agent_id)
     eh.update_events(command_events)
 
@@ -206,20 +350,81 @@ async def start_sync(agent_id: int) -> None:
             and key == "deleted"
         ):
             continue
+        if (
+            config.CONFIG.agent_fwd_cfg[agent_id].live.edit_sync is False
+            and key == "edited"
+        ):
+            continue
+        if (
+            config.CONFIG.agent_fwd_cfg[agent_id].show_forwarded_from
+            and key == "edited"
+        ):
+            # the copies are forwards, telegram does not allow editing them
+            logging.warning("Edits are not synced when 'Forwarded from' is shown")
+            continue
         client.add_event_handler(*val)
         logging.info(f"Added event handler for {key}")
 
-    if config.is_bot and const.REGISTER_COMMANDS:
-        await client(
-            functions.bots.SetBotCommandsRequest(
-                scope=types.BotCommandScopeDefault(),
-                lang_code="en",
-                commands=[
-                    types.BotCommand(command=key, description=value)
-                    for key, value in const.COMMANDS.items()
-                ],
+    if is_bot and const.REGISTER_COMMANDS:
+        with timed(f"Agent {agent_id}: registering commands"):
+            await client(
+                functions.bots.SetBotCommandsRequest(
+                    scope=types.BotCommandScopeDefault(),
+                    lang_code="en",
+                    commands=[
+                        types.BotCommand(command=key, description=value)
+                        for key, value in const.COMMANDS.items()
+                    ],
+                )
             )
+    return eh
+
+
+async def sync_agent(agent_id: int) -> None:
+    """Forward new messages of one agent until its client disconnects."""
+    SESSION = get_SESSION(agent_id)
+    client = TelegramClient(
+        SESSION,
+        CONFIG.login_cfg.tg.API_ID,
+        CONFIG.login_cfg.tg.API_HASH,
+        sequential_updates=CONFIG.agent_fwd_cfg[agent_id].live.sequential_updates,
+    )
+    eh = await login(agent_id, client)
+    checkpoints.restore(config.CONFIG.forwards)
+    with timed(f"Agent {agent_id}: loading forwards"):
+        from_to = await config.load_from_to(agent_id, client, config.CONFIG.forwards)
+    config.from_to = from_to
+    # catch up on what was missed while not running, if history can be read
+    missed = {}
+    if CONFIG.login_cfg.agents[agent_id].user_type == 1:
+        missed = {
+            src: route for src, route in from_to.items() if route["forward"].offset
+        }
+    eh.update_from_to({k: v for k, v in from_to.items() if k not in missed})
+    retries = asyncio.create_task(dead_letters.run(agent_id, client))
+    try:
+        await run_backfills(
+            agent_id,
+            missed,
+            lambda src, route: eh.catch_up(
+                src, route, partial(backfill, agent_id, client)
+            ),
         )
-    config.from_to = await config.load_from_to(agent_id, client, config.CONFIG.forwards)
-    eh.update_from_to(config.from_to)
-    await client.run_until_disconnected()
+        await client.run_until_disconnected()
+    finally:
+        retries.cancel()
+        await eh.finish()
+
+
+async def start_sync(agent_id: int) -> None:
+    """Start tgcf live sync."""
+    global current_agent
+    current_agent = agent_id
+    logging.getLogger("telethon").setLevel(logging.WARNING)
+
+    # load async plugins defined in plugin_models
+    await load_async_plugins()
+    try:
+        await sync_agent(agent_id)
+    finally:
+        await close_stores()
@@ -0,0 +1,180 @@
+"""Keep the media downloaded for plugins in memory, or in a spool on disk.
+
+Small files stay in memory and are handed to telethon and the plugins as
+named BytesIO objects, as long as all of them take at most
+MEDIA_MEMORY_BUDGET bytes. Others are written with aiofiles to a spool
+directory, whose files may take at most SPOOL_MAX_SIZE bytes together.
+"""
+
+import asyncio
+import atexit
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from io import BytesIO
+from typing import Dict, Optional, Union
+
+import aiofiles
+from telethon.tl.custom.message import Message
+
+from tgcf.const import (
+    MEDIA_MEMORY_BUDGET,
+    MEDIA_MEMORY_LIMIT,
+    SPOOL_DIR,
+    SPOOL_ENV_VAR_NAME,
+    SPOOL_MAX_SIZE,
+    SPOOL_WAIT,
+)
+from tgcf.utils import safe_name
+
+
+class Spool:
+    """A directory for large files, with a cap on their total size.
+
+    Every process gets its own directory inside it, removed when it exits.
+    """
+
+    def __init__(self, directory: str = SPOOL_DIR, max_size: int = SPOOL_MAX_SIZE):
+        self.base = os.getenv(SPOOL_ENV_VAR_NAME) or os.path.join(
+            tempfile.gettempdir(), directory
+        )
+        self.max_size = max_size
+        self.directory: Optional[str] = None
+        self.sizes: Dict[str, int] = {}
+        self.freed: Optional[asyncio.Event] = None
+
+    @property
+    def used(self) -> int:
+        return sum(self.sizes.values())
+
+    def _new_path(self, name: str) -> str:
+        if self.directory is None:
+            os.makedirs(self.base, exist_ok=True)
+            self.directory = tempfile.mkdtemp(dir=self.base)
+            atexit.register(shutil.rmtree, self.directory, True)
+            self.freed = asyncio.Event()
+        return os.path.join(self.directory, f"{uuid.uuid4().hex}_{safe_name(name)}")
+
+    async def allocate(self, name: str, size: int) -> str:
+        """Return a new path for a file of size bytes, once there is room for it.
+
+        After SPOOL_WAIT seconds the cap is exceeded, since the files taking
+        the room may belong to messages queued behind this one.
+        """
+        path = self._new_path(name)
+        if self.sizes and self.used + size > self.max_size:
+            logging.info(f"Spool is full, waiting to store {name}")
+            try:
+                await asyncio.wait_for(self._room(size), SPOOL_WAIT)
+            except asyncio.TimeoutError:
+                logging.warning(f"Spool is still full, storing {name} anyway")
+        self.sizes[path] = size
+        return path
+
+    async def _room(self, size: int) -> None:
+        while self.sizes and self.used + size > self.max_size:
+            self.freed.clear()
+            await self.freed.wait()
+
+    def release(self, path: str) -> None:
+        """Delete a file, making room for others if it was in the spool."""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        if self.sizes.pop(path, None) is not None:
+            self.freed.set()
+
+
+spool = Spool()
+
+
+class MemoryBudget:
+    """Bytes of media kept in memory by all messages together."""
+
+    def __init__(self, limit: int = MEDIA_MEMORY_BUDGET) -> None:
+        self.limit = limit
+        self.used = 0
+
+    def take(self, size: int) -> bool:
+        """Count size bytes against the budget, if they fit in it."""
+        if self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+
+    def give(self, size: int) -> None:
+        self.used -= size
+
+
+memory = MemoryBudget()
+
+
+class Media:
+    """The file of a message, downloaded at most once."""
+
+    def __init__(self, message: Message) -> None:
+        self.message = message
+        file = message.file
+        if file is None:
+            # a contact has no file, download_media makes a vcard of it in memory
+            self.name = f"{message.id}.vcf"
+            self.size = 0
+        else:
+            self.name = file.name or f"{message.id}{file.ext or ''}"
+            self.size = file.size or 0
+        self.data: Optional[bytes] = None
+        self.held = 0
+        self.path: Optional[str] = None
+
+    async def load(self) -> None:
+        """Download the file, into memory if it is small and there is room."""
+        if self.size <= MEDIA_MEMORY_LIMIT and memory.take(self.size):
+            self.held = self.size
+            try:
+                self.data = await self.message.download_media(bytes)
+            except BaseException:
+                self.release()
+                raise
+            return
+        self.path = await spool.allocate(self.name, self.size)
+        try:
+            async with aiofiles.open(self.path, "wb") as file:
+                async for chunk in self.message.client.iter_download(
+                    self.message.media
+                ):
+                    await file.write(chunk)
+        except BaseException:
+            self.release()
+            raise
+
+    def open(self) -> Union[BytesIO, str]:
+        """Return the file as a named BytesIO if in memory, else its path."""
+        if self.data is None:
+            return self.path
+        buffer = BytesIO(self.data)
+        buffer.name = self.name
+        return buffer
+
+    async def to_path(self) -> str:
+        """Return the path of the file, spooling it if it is in memory."""
+        if self.path is None:
+            path = await spool.allocate(self.name, len(self.data))
+            try:
+                async with aiofiles.open(path, "wb") as file:
+                    await file.write(self.data)
+            except BaseException:
+                spool.release(path)
+                raise
+            self.path = path
+        return self.path
+
+    def release(self) -> None:
+        self.data = None
+        memory.give(self.held)
+        self.held = 0
+        if self.path:
+            spool.release(self.path)
+            self.path = None
@@ -0,0 +1,46 @@
+"""The module for running many agents in one process.
+
+Every agent gets its own client, but they share one event loop, the loaded
+plugins, the config and the checkpoints. Each agent runs in the mode set for
+it in its forwarding config.
+"""
+
+import asyncio
+import logging
+from typing import List
+
+from tgcf.config import CONFIG
+from tgcf.delivery import close_stores
+from tgcf.live import sync_agent
+from tgcf.past import forward_agent
+from tgcf.past_live import ForwardJob
+from tgcf.plugins import load_async_plugins
+
+
+async def run_agent(agent_id: int) -> None:
+    """Run one agent, a failing agent does not stop the others."""
+    mode = CONFIG.agent_fwd_cfg[agent_id].mode
+    logging.info(f"Starting agent {agent_id} in mode {mode}")
+    try:
+        if mode == 1:
+            await forward_agent(agent_id)
+        elif mode == 2:
+            await ForwardJob().sync_agent(agent_id)
+        else:
+            await sync_agent(agent_id)
+    except (Exception, SystemExit) as err:
+        logging.exception(f"Agent {agent_id} stopped: {err!r}")
+    else:
+        logging.info(f"Agent {agent_id} finished")
+
+
+async def run_agents(agent_ids: List[int]) -> None:
+    """Run the given agents together until all of them are done."""
+    logging.getLogger("telethon").setLevel(logging.WARNING)
+
+    # load async plugins defined in plugin_models, once for all agents
+    await load_async_plugins()
+    try:
+        await asyncio.gather(*(run_agent(agent_id) for agent_id in agent_ids))
+    finally:
+        await close_stores()
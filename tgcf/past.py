@@ -7,25 +7,50 @@
 import asyncio
 import logging
 import time
+from contextlib import aclosing
+from itertools import groupby
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 
 from telethon import TelegramClient
-from telethon.errors.rpcerrorlist import FloodWaitError
 from telethon.tl.custom.message import Message
 from telethon.tl.patched import MessageService
 
 from tgcf import config
 from tgcf import storage as st
-from tgcf.config import CONFIG, get_SESSION, write_config
-from tgcf.plugins import apply_plugins, load_async_plugins
-from tgcf.utils import clean_session_files, send_message
+from tgcf.checkpoint import checkpoints
+from tgcf.config import CONFIG, get_SESSION
+from tgcf.const import (
+    BULK_FORWARD_SIZE,
+    PAST_CHUNK_SIZE,
+    PAST_PIPELINE_SIZE,
+    PAST_PROGRESS_EVERY,
+    PAST_READ_AHEAD,
+    PAST_READERS,
+)
+from tgcf.deadletter import dead_letters
+from tgcf.delivery import close_stores, deliver
+from tgcf.plugins import (
+    TgcfMessage,
+    _apply_plugins,
+    chain_plugins,
+    load_async_plugins,
+    plugins,
+)
+from tgcf.utils import fan_out, forward_messages, timed
 
 
 async def forward_job(agent_id: int) -> None:
     """Forward all existing messages in the concerned chats."""
-    clean_session_files()
-
     # load async plugins defined in plugin_models
     await load_async_plugins()
+    try:
+        await forward_agent(agent_id)
+    finally:
+        await close_stores()
+
+
+async def forward_agent(agent_id: int) -> None:
+    """Forward the existing messages of the chats of one agent."""
     agent = CONFIG.login_cfg.agents[agent_id]
     if agent.user_type != 1:
         logging.warning(
@@ -39,92 +64,358 @@ async def forward_job(agent_id: int) -> None:
         active_forwards = await config.load_active_forwards(
             agent_id, config.CONFIG.forwards
         )
-        config.from_to = await config.load_from_to(agent_id, client, active_forwards)
-        client: TelegramClient
-        for from_to, forward in zip(config.from_to.items(), active_forwards):
-            src, destV = from_to
-            dest = destV["dest"]
-            pcfg_id = destV["pcfg"]
-            last_id = 0
-            forward: config.Forward
-            logging.info(f"Forwarding messages from {src} to {dest}")
-            tm = None
-            async for message in client.iter_messages(
-                src, reverse=True, offset_id=forward.offset
-            ):
-                message: Message
-                event = st.DummyEvent(message.chat_id, message.id)
-                event_uid = st.EventUid(event)
+        checkpoints.restore(active_forwards)
+        with timed(f"Agent {agent_id}: loading forwards"):
+            from_to = await config.load_from_to(agent_id, client, active_forwards)
+        config.from_to = from_to
+        retries = asyncio.create_task(dead_letters.run(agent_id, client))
+        try:
+            await run_backfills(
+                agent_id,
+                from_to,
+                lambda src, route: backfill(agent_id, client, src, route),
+            )
+        finally:
+            retries.cancel()
+        # sends that failed late in the backfills may be due by now
+        await dead_letters.retry_due(agent_id, client)
 
-                if forward.end and last_id > forward.end:
-                    continue
+
+async def run_backfills(
+    agent_id: int,
+    from_to: Dict[int, Dict[str, Any]],
+    job: Callable[[int, Dict[str, Any]], Awaitable[Any]],
+) -> None:
+    """Run the backfill job of every source at the same time.
+
+    At most `past.concurrency` of them run at once. A failing backfill is
+    logged and does not stop the others.
+    """
+    limit = asyncio.Semaphore(CONFIG.agent_fwd_cfg[agent_id].past.concurrency)
+
+    async def _run(src: int, route: Dict[str, Any]) -> None:
+        async with limit:
+            try:
+                await job(src, route)
+            except Exception as err:
+                logging.exception(f"Backfill of {src} failed: {err}")
+
+    with timed(f"Agent {agent_id}: backfilling {len(from_to)} sources"):
+        await asyncio.gather(*(_run(src, route) for src, route in from_to.items()))
+
+
+async def read_history(
+    client: TelegramClient, src: int, offset: int, end: int = 0
+) -> AsyncIterator[Message]:
+    """Yield the messages of a source after offset, up to end if set, in order.
+
+    A long id range is split in chunks of PAST_CHUNK_SIZE ids. Up to
+    PAST_READERS chunks are read at the same time, each into a queue of up to
+    PAST_READ_AHEAD messages, so the later ones download many pages while
+    the current one is yielded. They are yielded one chunk after the other.
+    """
+    if end:
+        top = end
+    else:
+        latest = await client.get_messages(src, limit=1)
+        top = latest[0].id if latest else 0
+    bounds = list(range(offset, top, PAST_CHUNK_SIZE))[1:]
+    # ranges of ids after the first and up to the second, the last one is
+    # left open if no end is set, to get messages sent while reading
+    ranges = list(zip([offset, *bounds], [*bounds, end]))
+
+    def messages(after: int, upto: int) -> AsyncIterator[Message]:
+        return client.iter_messages(
+            src, reverse=True, offset_id=after, max_id=upto + 1 if upto else 0
+        )
+
+    if len(ranges) == 1:
+        async for message in messages(*ranges[0]):
+            yield message
+        return
+
+    async def read(after: int, upto: int, queue: asyncio.Queue) -> None:
+        try:
+            async for message in messages(after, upto):
+                await queue.put(message)
+        except Exception as err:
+            await queue.put(err)
+        else:
+            await queue.put(None)
+
+    logging.info(f"Reading {src} in {len(ranges)} chunks, from id {offset} to {top}")
+    readers: List[Tuple[asyncio.Task, asyncio.Queue]] = []
+    try:
+        for i in range(len(ranges)):
+            while len(readers) < PAST_READERS and i + len(readers) < len(ranges):
+                queue: asyncio.Queue = asyncio.Queue(PAST_READ_AHEAD)
+                task = asyncio.create_task(read(*ranges[i + len(readers)], queue))
+                readers.append((task, queue))
+            _, queue = readers.pop(0)
+            while (item := await queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+    finally:
+        for task, _ in readers:
+            task.cancel()
+
+
+def can_bulk_forward(agent_id: int, pcfg_id: int) -> bool:
+    """Tell whether the messages reach the destinations exactly as they are."""
+    pcfg = plugins[pcfg_id]
+    if CONFIG.agent_fwd_cfg[agent_id].show_forwarded_from:
+        # the originals are forwarded anyway, unless another client sends them
+        return "sender" not in pcfg
+    return not any(plugin.rewrites for plugin in pcfg.values())
+
+
+async def backfill(
+    agent_id: int, client: TelegramClient, src: int, route: Dict[str, Any]
+) -> int:
+    """Forward the existing messages of one source, from its offset on.
+
+    Reading the history, applying the plugins and sending run as a pipeline.
+    A reader fetches messages, a pool of workers applies the plugins to them,
+    and this coroutine sends the results in the order the messages were read.
+    Plugins run their blocking work in threads, so the workers overlap with
+    reading and sending. Every stage waits when more than PAST_PIPELINE_SIZE
+    messages are in flight.
+
+    Returns:
+        int: the number of messages read
+    """
+    dest = route["dest"]
+    pcfg_id = route["pcfg"]
+    forward: config.Forward = route["forward"]
+    if can_bulk_forward(agent_id, pcfg_id):
+        return await bulk_backfill(agent_id, client, src, route)
+    logging.info(f"Forwarding messages from {src} to {dest}")
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    # to the workers, and in reading order to the sender
+    todo: asyncio.Queue = asyncio.Queue(PAST_PIPELINE_SIZE)
+    ordered: asyncio.Queue = asyncio.Queue(PAST_PIPELINE_SIZE)
+
+    async def read() -> None:
+        try:
+            async for message in read_history(
+                client, src, forward.offset, forward.end
+            ):
                 if isinstance(message, MessageService):
                     continue
-                try:
-
-                    tm = await apply_plugins(pcfg_id, message, tm)
-                    # tm = await apply_plugins_with_tm(pcfg_id, message, tm)
-                    if not tm:
-                        continue
-                    if not tm.get_next():
-                        continue
-                    message = tm.get_first_message()
-                    if message:
-                        st.stored[event_uid] = {}
-    
-                        if message.is_reply:
-                            r_event = st.DummyEvent(
-                                message.chat_id, message.reply_to_msg_id
-                            )
-                            r_event_uid = st.EventUid(r_event)
-                        for d in dest:
-                            if message.is_reply and r_event_uid in st.stored:
-                                tm.reply_to = st.stored.get(r_event_uid).get(d)
-                            fwded_msg = await send_message(agent_id, d, tm)
-                        # st.stored[event_uid].update({d: fwded_msg.id})
-
-                    forward.offset = tm.get_last_id()
-                    logging.info(f"forwarding message with id = {forward.offset}")
-                    write_config(CONFIG, persist=False)
-                    if message:
-                        time.sleep(CONFIG.agent_fwd_cfg[agent_id].past.delay)
-                    logging.info(
-                        f"slept for {CONFIG.agent_fwd_cfg[agent_id].past.delay} seconds"
-                    )
-                    
-                    tm.clear()
-                    tm = tm.get_next()
-
-                except FloodWaitError as fwe:
-                    logging.info(f"Sleeping for {fwe}")
-                    await asyncio.sleep(delay=fwe.seconds)
-                except Exception as err:
-                    logging.exception(err)
-                    tm = None
-            # process the last msg
-            if tm:
-                st.stored[event_uid] = {}
-                message = tm.get_first_message()
-                if message:
-                    event = st.DummyEvent(message.chat_id, message.id)
-                    event_uid = st.EventUid(event)
-                    if message.is_reply:
-                        r_event = st.DummyEvent(
-                            message.chat_id, message.reply_to_msg_id
-                        )
-                        r_event_uid = st.EventUid(r_event)
-                    for d in dest:
-                        if message.is_reply and r_event_uid in st.stored:
-                            tm.reply_to = st.stored.get(r_event_uid).get(d)
-                        fwded_msg = await send_message(agent_id, d, tm)
-                        # st.stored[event_uid].update({d: fwded_msg.id})
-                
-                forward.offset = tm.get_last_id()
-                logging.info(f"forwarding message with id = {forward.offset}")
-                write_config(CONFIG, persist=False)
-                if message:
-                    time.sleep(CONFIG.agent_fwd_cfg[agent_id].past.delay)
+                result = loop.create_future()
+                await ordered.put((message, result))
+                await todo.put((message, result))
+        except Exception as err:
+            await ordered.put(err)
+        else:
+            await ordered.put(None)
+
+    async def work() -> None:
+        while True:
+            message, result = await todo.get()
+            try:
+                result.set_result(await _apply_plugins(pcfg_id, message))
+            except Exception as err:
+                result.set_exception(err)
+
+    workers = CONFIG.agent_fwd_cfg[agent_id].past.plugin_workers
+    if any(plugin.ordered for plugin in plugins[pcfg_id].values()):
+        workers = 1
+    tasks = [asyncio.create_task(read())]
+    tasks += [asyncio.create_task(work()) for _ in range(workers)]
+    count = 0
+    tm = None
+    try:
+        while True:
+            item = await ordered.get()
+            if isinstance(item, Exception):
+                if tm:
+                    tm.clear_chain()
+                raise item
+            if item is None:
+                break
+            message, result = item
+            count += 1
+            if count % PAST_PROGRESS_EVERY == 0:
+                rate = count / (time.perf_counter() - start)
                 logging.info(
-                    f"slept for {CONFIG.agent_fwd_cfg[agent_id].past.delay} seconds"
+                    f"Backfill of {src}: {count} messages read, at id {message.id},"
+                    f" {rate:.1f} messages/s"
                 )
+            try:
+                tm = chain_plugins(message, await result, tm)
+                if not tm.get_next():
+                    continue
+                await send_backfilled(agent_id, route, tm)
+                tm = tm.get_next()
+            except Exception as err:
+                logging.exception(err)
+                if tm:
+                    tm.clear_chain()
+                tm = None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # free the files of the messages left in the pipeline
+        while not ordered.empty():
+            item = ordered.get_nowait()
+            if not isinstance(item, tuple) or not item[1].done():
+                continue
+            result = item[1]
+            if not result.cancelled() and not result.exception() and result.result():
+                result.result().clear()
+    # process the last msg
+    if tm:
+        await send_backfilled(agent_id, route, tm)
+    logging.info(
+        f"Backfill of {src} done: {count} messages read,"
+        f" offset {forward.offset}, took {time.perf_counter() - start:.1f}s"
+    )
+    return count
+
+
+async def send_backfilled(
+    agent_id: int, route: Dict[str, Any], tm: TgcfMessage
+) -> None:
+    """Send a message or album to all destinations, then wait the past delay."""
+    forward: config.Forward = route["forward"]
+    message = tm.get_first_message()
+    await deliver(agent_id, route, tm)
+    logging.info(f"forwarding message with id = {forward.offset}")
+    if message:
+        await asyncio.sleep(CONFIG.agent_fwd_cfg[agent_id].past.delay)
+    logging.info(f"slept for {CONFIG.agent_fwd_cfg[agent_id].past.delay} seconds")
+    tm.clear()
+
+
+async def bulk_backfill(
+    agent_id: int, client: TelegramClient, src: int, route: Dict[str, Any]
+) -> int:
+    """Forward the existing messages of one source in batches.
+
+    Used when no plugin changes the messages. The ones passing the filters are
+    forwarded BULK_FORWARD_SIZE at a time, an album is never split over two
+    batches. Without show_forwarded_from, the author is dropped, so they
+    arrive as copies. A forwarded copy can not reply to the copy of another
+    message though. So then a reply, with the rest of its album, is sent on
+    its own after the batch before it, and batching goes on after it.
+
+    Returns:
+        int: the number of messages read
+    """
+    pcfg_id = route["pcfg"]
+    forward: config.Forward = route["forward"]
+    threaded = not CONFIG.agent_fwd_cfg[agent_id].show_forwarded_from
+    logging.info(f"Forwarding messages from {src} to {route['dest']} in bulk")
+    start = time.perf_counter()
+    count = 0
+    last_id = None
+    batch: List[Message] = []
+    # a replying album, sent on its own once all its parts are read
+    album: Optional[TgcfMessage] = None
+    history = read_history(client, src, forward.offset, forward.end)
+    async with aclosing(history):
+        async for message in history:
+            if isinstance(message, MessageService):
+                continue
+            count += 1
+            last_id = message.id
+            if count % PAST_PROGRESS_EVERY == 0:
+                rate = count / (time.perf_counter() - start)
+                logging.info(
+                    f"Backfill of {src}: {count} messages read, at id {message.id},"
+                    f" {rate:.1f} messages/s"
+                )
+            tm = await _apply_plugins(pcfg_id, message)
+            if not tm:
+                continue
+            if album and message.grouped_id == album.grouped_id:
+                album.add_grouped_file(message)
+                album.add_text(message.text)
+                album.last_id = message.id
                 tm.clear()
+                continue
+            if album:
+                await send_backfilled(agent_id, route, album)
+                album = None
+            if threaded and message.is_reply:
+                # the parts of its album read so far go with it
+                parts: List[Message] = []
+                while (
+                    message.grouped_id
+                    and batch
+                    and batch[-1].grouped_id == message.grouped_id
+                ):
+                    parts.insert(0, batch.pop())
+                if batch:
+                    await forward_batch(agent_id, client, route, batch)
+                    batch = []
+                if not message.grouped_id:
+                    await send_backfilled(agent_id, route, tm)
+                    continue
+                tm.clear()
+                parts.append(message)
+                album = TgcfMessage(parts[0])
+                for part in parts:
+                    album.add_grouped_file(part)
+                for part in parts[1:]:
+                    album.add_text(part.text)
+                album.last_id = message.id
+                continue
+            tm.clear()
+            if len(batch) >= BULK_FORWARD_SIZE:
+                cut = len(batch)
+                if message.grouped_id:
+                    # keep the parts of the album read so far for the next batch
+                    while cut and batch[cut - 1].grouped_id == message.grouped_id:
+                        cut -= 1
+                await forward_batch(agent_id, client, route, batch[: cut or None])
+                batch = batch[cut:] if cut else []
+            batch.append(message)
+    if album:
+        await send_backfilled(agent_id, route, album)
+    if batch:
+        await forward_batch(agent_id, client, route, batch)
+    if last_id is not None and last_id > forward.offset:
+        # the messages filtered out after the last batch
+        checkpoints.update(forward, last_id)
+    logging.info(
+        f"Backfill of {src} done: {count} messages read,"
+        f" offset {forward.offset}, took {time.perf_counter() - start:.1f}s"
+    )
+    return count
+
+
+async def forward_batch(
+    agent_id: int, client: TelegramClient, route: Dict[str, Any], batch: List[Message]
+) -> None:
+    """Forward a batch of messages to all destinations and move the offset past it.
+
+    Messages a destination got before a restart are not forwarded to it again.
+    """
+    drop_author = not CONFIG.agent_fwd_cfg[agent_id].show_forwarded_from
+    offset = route["forward"].offset
+    copied = [st.stored.earlier_copies(st.EventUid(m), offset) for m in batch]
+    todo = {
+        d: [m for m, c in zip(batch, copied) if d not in c] for d in route["dest"]
+    }
+    fwded_msgs, failed = await fan_out(
+        agent_id,
+        [d for d in route["dest"] if todo[d]],
+        lambda d: forward_messages(agent_id, client, d, todo[d], drop_author),
+    )
+    for dest, fwded in fwded_msgs.items():
+        for original, copy in zip(todo[dest], fwded):
+            if copy:
+                st.stored.add(st.EventUid(original), dest, [copy.id])
+    if failed:
+        # one letter per album, so a retry sends it as an album again, other
+        # messages get a key of their own
+        for _, group in groupby(batch, lambda m: m.grouped_id or -m.id):
+            dead_letters.add(agent_id, route["pcfg"], list(group), failed)
+    checkpoints.update(route["forward"], batch[-1].id)
+    logging.info(f"forwarded {len(batch)} messages up to id {batch[-1].id}")
+    await asyncio.sleep(CONFIG.agent_fwd_cfg[agent_id].past.delay)
@@ -0,0 +1,88 @@
+"""Cache the input peers of destinations, so sending needs no entity lookups.
+
+Telethon turns every chat id passed to a request into an input peer. Doing it
+once per client and chat, when the forwards are loaded, keeps that off the
+path of every message.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, TypeVar, Union
+
+from telethon import TelegramClient
+from telethon.errors.rpcerrorlist import ChannelInvalidError, PeerIdInvalidError
+from telethon.tl.types import TypeInputPeer
+
+from tgcf.const import RESOLVE_CONCURRENCY
+
+T = TypeVar("T")
+Peer = Union[TypeInputPeer, int]
+
+
+class PeerCache:
+    """Input peers of chats, kept per client since access hashes differ."""
+
+    def __init__(self) -> None:
+        self.peers: Dict[TelegramClient, Dict[int, Peer]] = {}
+
+    async def resolve(self, client: TelegramClient, chat_id: int) -> Peer:
+        """Look up the input peer of a chat and cache it.
+
+        If it cannot be found, the chat id is kept for telethon to handle.
+        """
+        try:
+            peer = await client.get_input_entity(chat_id)
+        except (ValueError, ChannelInvalidError, PeerIdInvalidError) as err:
+            logging.warning(f"Could not resolve input peer of {chat_id}: {err}")
+            peer = chat_id
+        self.peers.setdefault(client, {})[chat_id] = peer
+        return peer
+
+    async def load(
+        self,
+        client: TelegramClient,
+        chat_ids: Iterable[int],
+        limit: int = RESOLVE_CONCURRENCY,
+    ) -> None:
+        """Resolve many chats at once, at most limit at a time."""
+        semaphore = asyncio.Semaphore(limit)
+
+        async def _resolve(chat_id: int) -> None:
+            async with semaphore:
+                await self.resolve(client, chat_id)
+
+        await asyncio.gather(*(_resolve(chat_id) for chat_id in set(chat_ids)))
+
+    async def get(self, client: TelegramClient, chat_id: int) -> Peer:
+        """Return the cached input peer of a chat, resolving it if needed."""
+        peer = self.peers.get(client, {}).get(chat_id)
+        if peer is None:
+            peer = await self.resolve(client, chat_id)
+        return peer
+
+    def invalidate(self, client: TelegramClient, chat_id: int) -> None:
+        self.peers.get(client, {}).pop(chat_id, None)
+
+    async def call(
+        self,
+        client: TelegramClient,
+        chat_id: int,
+        func: Callable[[Peer], Awaitable[T]],
+    ) -> T:
+        """Make a request to a chat with its input peer.
+
+        If telegram rejects the peer, it is looked up once more and the
+        request is repeated.
+        """
+        peer = await self.get(client, chat_id)
+        try:
+            return await func(peer)
+        except (ChannelInvalidError, PeerIdInvalidError) as err:
+            if isinstance(peer, int):
+                raise
+            logging.warning(f"Input peer of {chat_id} is invalid, refreshing: {err}")
+            self.invalidate(client, chat_id)
+            return await func(await self.resolve(client, chat_id))
+
+
+peers = PeerCache()
@@ -112,4 +112,4 @@ class PluginConfig(BaseModel):
 
 
 # List of plugins that need to load asynchronously
-ASYNC_PLUGIN_IDS = ["sender", "gsheet_logger"]
+ASYNC_PLUGIN_IDS = ["sender", "gsheet_logger", "mark"]
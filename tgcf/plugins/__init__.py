@@ -4,17 +4,21 @@ Contains all the first-party tgcf plugins.
 """
 
 
+import asyncio
 import inspect
 import logging
 from enum import Enum
 from importlib import import_module
-from typing import Any, Dict
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from telethon.tl.custom.message import Message
+from telethon.tl.types import TypeDocumentAttribute, TypeInputFile
+from telethon.utils import get_attributes
 
 from tgcf.config import CONFIG
+from tgcf.media import Media, spool
 from tgcf.plugin_models import ASYNC_PLUGIN_IDS, FileType
-from tgcf.utils import cleanup, stamp
 
 # PLUGINS = CONFIG.plugin_cfgs
 
@@ -26,7 +30,10 @@ class TgcfMessage:
         self.raw_text = self.message.raw_text
         self.sender_id = self.message.sender_id
         self.file_type = self.guess_file_type()
+        self.media: Optional[Media] = None
         self.new_file = None
+        self.uploaded: Optional[Tuple[TypeInputFile, List[TypeDocumentAttribute]]] = None
+        self.upload_lock = asyncio.Lock()
         self.cleanup = False
         self.reply_to = None
         self.client = self.message.client
@@ -36,12 +43,40 @@ class TgcfMessage:
         self.next_text = ''
         self.last_id = message.id
 
-    async def get_file(self) -> str:
-        """Downloads the file in the message and returns the path where its saved."""
+    async def get_file(self) -> Union[BytesIO, str]:
+        """Downloads the file in the message and returns it.
+
+        A small file is returned as a named BytesIO, a large one as the path
+        where it is spooled. It is downloaded only once, all plugins get the
+        same file. They must not change or delete it, that happens when the
+        message is cleared.
+        """
         if self.file_type == FileType.NOFILE:
             raise FileNotFoundError("No file exists in this message.")
-        self.file = stamp(await self.message.download_media(""), self.sender_id)
-        return self.file
+        if self.media is None:
+            media = Media(self.message)
+            await media.load()
+            self.media = media
+        return self.media.open()
+
+    async def get_file_path(self) -> str:
+        """Like get_file, but always returns a path, for tools that need one."""
+        await self.get_file()
+        return await self.media.to_path()
+
+    async def upload(self) -> Tuple[TypeInputFile, List[TypeDocumentAttribute]]:
+        """Upload the new file once, the handle is reused for every destination.
+
+        The attributes are read from the file before, telethon can not do that
+        for an uploaded one.
+        """
+        async with self.upload_lock:
+            if self.uploaded is None:
+                attributes, _ = get_attributes(self.new_file)
+                handle = await self.client.upload_file(self.new_file)
+                self.uploaded = (handle, attributes)
+        return self.uploaded
+
     # def get_last_id(self):
     #     if self.grouped_files:
     #         return self.grouped_files[-1].id
@@ -85,14 +120,31 @@ class TgcfMessage:
                 return i
 
     def clear(self) -> None:
+        """Delete the files of the message, once it was sent or dropped."""
+        self.uploaded = None
         if self.new_file and self.cleanup:
-            cleanup(self.new_file)
+            if isinstance(self.new_file, str):
+                spool.release(self.new_file)
             self.new_file = None
+        if self.media:
+            self.media.release()
+            self.media = None
         if self.grouped_files and self.cleanup:
             self.grouped_files = []
 
+    def clear_chain(self) -> None:
+        """Clear this message and every message waiting after it."""
+        tm = self
+        while tm:
+            tm.clear()
+            tm = tm.get_next()
+
 class TgcfPlugin:
     id_ = "plugin"
+    # set when modify depends on the messages before, it then gets them in order
+    ordered = False
+    # unset when modify only filters messages, and never changes what is sent
+    rewrites = True
 
     def __init__(self, data: Dict[str, Any]) -> None:  # TODO data type has changed
         self.data = data
@@ -155,7 +207,14 @@ def load_plugins() -> Dict[int, Dict[str, TgcfPlugin]]:
 
 
 async def load_async_plugins() -> None:
-    """Load async plugins specified plugin_models."""
+    """Load async plugins specified plugin_models.
+
+    The plugins are shared by all agents of the process, so this runs once.
+    """
+    global async_loaded
+    if async_loaded:
+        return
+    async_loaded = True
     if plugins:
         for pcfg_id, cfg in plugins.items():
             for _id in ASYNC_PLUGIN_IDS:
@@ -218,11 +277,22 @@ async def _apply_plugins(pcfg_id: int, message: Message) -> TgcfMessage | None:
 #                     new_tm.text = pre_tm.next_text
 #         return pre_tm
 async def apply_plugins(pcfg_id: int, message: Message, pre_tm: TgcfMessage | None = None) -> TgcfMessage:
+    new_tm = await _apply_plugins(pcfg_id, message)
+    return chain_plugins(message, new_tm, pre_tm)
+
+
+def chain_plugins(
+    message: Message, new_tm: TgcfMessage | None, pre_tm: TgcfMessage | None = None
+) -> TgcfMessage:
+    """Link the result of _apply_plugins for a message to the messages before it.
+
+    Album parts are merged into one message, anything else is set as the next
+    message to send. Must be called in the order of the messages.
+    """
     if not pre_tm:
         pre_tm = TgcfMessage(message)
         pre_tm.message = None
 
-    new_tm = await _apply_plugins(pcfg_id, message)
     if not new_tm:
         if not message.grouped_id:
             pre_tm.last_id = message.id
@@ -244,6 +314,8 @@ async def apply_plugins(pcfg_id: int, message: Message, pre_tm: TgcfMessage | No
                 pre_tm.add_grouped_file(message)
                 pre_tm.add_text(new_tm.text)
                 pre_tm.last_id = message.id
+                # only the text of a merged part is used
+                new_tm.clear()
             else:
                 logging.info(f"old grouped id is {pre_tm.grouped_id}, and new grouped id is {new_tm.grouped_id}, set next")
                 new_tm.add_grouped_file(message)
@@ -252,3 +324,4 @@ async def apply_plugins(pcfg_id: int, message: Message, pre_tm: TgcfMessage | No
     
         
 plugins = load_plugins()
+async_loaded = False
@@ -10,6 +10,7 @@ from tgcf.utils import match
 
 class TgcfFilter(TgcfPlugin):
     id_ = "filter"
+    rewrites = False
 
     def __init__(self, data) -> None:
         self.filters = data
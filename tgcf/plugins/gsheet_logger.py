@@ -11,6 +11,8 @@ from io import StringIO
 
 class TgcfGsheetLogger(TgcfPlugin):
     id_ = "gsheet_logger"
+    ordered = True
+    rewrites = False
 
     def __init__(self, data: GsheetLogger) -> None:
         self.gsl = data
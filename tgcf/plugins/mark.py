@@ -1,31 +1,39 @@
+import asyncio
 import logging
 import os
 import shutil
-from typing import Any, Dict
+import tempfile
+from typing import Any, Dict, Optional
 
 import requests
 from pydantic import BaseModel  # pylint: disable=no-name-in-module
 from watermark import File, Position, Watermark, apply_watermark
 
+from tgcf.media import spool
 from tgcf.plugin_models import MarkConfig
 from tgcf.plugins import TgcfMessage, TgcfPlugin
-from tgcf.utils import cleanup
 
 
 def download_image(url: str, filename: str = "image.png") -> bool:
+    """Download the image, it appears under filename only once complete."""
     if filename in os.listdir():
         logging.info("Image for watermarking already exists.")
         return True
+    fd, part = tempfile.mkstemp(dir=".", suffix=".part")
     try:
-        logging.info(f"Downloading image {url}")
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
+        with os.fdopen(fd, "wb") as file:
+            logging.info(f"Downloading image {url}")
+            response = requests.get(url, stream=True)
+            if response.status_code != 200:
+                raise ValueError(f"Got response {response.status_code} for {url}")
             logging.info("Got Response 200")
-            with open(filename, "wb") as file:
-                response.raw.decode_content = True
-                shutil.copyfileobj(response.raw, file)
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, file)
+        os.replace(part, filename)
     except Exception as err:
         logging.error(err)
+        if os.path.exists(part):
+            os.remove(part)
         return False
     else:
         logging.info("File created image")
@@ -37,19 +45,43 @@ class TgcfMark(TgcfPlugin):
 
     def __init__(self, data) -> None:
         self.data = data
+        self.overlay: Optional[str] = None
+        self.overlay_lock = asyncio.Lock()
+
+    async def __ainit__(self) -> None:
+        await self.get_overlay()
+
+    async def get_overlay(self) -> Optional[str]:
+        """Return the path of the overlay image, it is downloaded only once."""
+        async with self.overlay_lock:
+            if self.overlay is None:
+                if not self.data.image.startswith("https://"):
+                    self.overlay = self.data.image
+                elif await asyncio.to_thread(download_image, self.data.image):
+                    self.overlay = "image.png"
+        return self.overlay
 
     async def modify(self, tm: TgcfMessage) -> TgcfMessage:
         if not tm.file_type in ["gif", "video", "photo"]:
             return tm
-        downloaded_file = await tm.get_file()
+        overlay = await self.get_overlay()
+        if overlay is None:
+            raise ValueError(f"Could not download the image {self.data.image}")
+        downloaded_file = await tm.get_file_path()
         base = File(downloaded_file)
-        if self.data.image.startswith("https://"):
-            download_image(self.data.image)
-            overlay = File("image.png")
-        else:
-            overlay = File(self.data.image)
-        wtm = Watermark(overlay, self.data.position)
-        tm.new_file = apply_watermark(base, wtm, frame_rate=self.data.frame_rate)
-        cleanup(downloaded_file)
+        wtm = Watermark(File(overlay), self.data.position)
+        output = await spool.allocate(f"watered_{tm.media.name}", tm.media.size)
+        try:
+            # ffmpeg blocks, keep it off the event loop
+            tm.new_file = await asyncio.to_thread(
+                apply_watermark,
+                base,
+                wtm,
+                output_file=output,
+                frame_rate=self.data.frame_rate,
+            )
+        except Exception:
+            spool.release(output)
+            raise
         tm.cleanup = True
         return tm
@@ -1,8 +1,9 @@
+import asyncio
+
 import pytesseract
 from PIL import Image
 
 from tgcf.plugins import TgcfMessage, TgcfPlugin
-from tgcf.utils import cleanup
 
 
 class TgcfOcr(TgcfPlugin):
@@ -17,6 +18,8 @@ class TgcfOcr(TgcfPlugin):
             return tm
 
         file = await tm.get_file()
-        tm.text = pytesseract.image_to_string(Image.open(file))
-        cleanup(file)
+        # tesseract blocks, keep it off the event loop
+        tm.text = await asyncio.to_thread(
+            lambda: pytesseract.image_to_string(Image.open(file))
+        )
         return tm
@@ -7,6 +7,8 @@ from tgcf.plugins import TgcfMessage, TgcfPlugin
 
 class TgcfUnique(TgcfPlugin):
     id_ = "unique"
+    ordered = True
+    rewrites = False
 
     def __init__(self, data) -> None:
         self.max = 5
@@ -1,12 +1,26 @@
-from typing import Dict
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from pymongo.collection import Collection
 from telethon.tl.custom.message import Message
 
+from tgcf.const import (
+    CHECKPOINT_LAG,
+    KEEP_LAST_MANY,
+    MESSAGE_MAP_BATCH,
+    MESSAGE_MAP_FILE_NAME,
+    MESSAGE_MAP_INTERVAL,
+)
+
 
 class EventUid:
     """The objects of this class uniquely identifies a message with its chat id and message id."""
 
+    __slots__ = ("chat_id", "msg_id")
+
     def __init__(self, event) -> None:
         self.chat_id = event.chat_id
         try:
@@ -21,7 +35,7 @@ class EventUid:
         return self.chat_id == other.chat_id and self.msg_id == other.msg_id
 
     def __hash__(self) -> int:
-        return hash(self.__str__())
+        return hash((self.chat_id, self.msg_id))
 
 
 class DummyEvent:
@@ -30,6 +44,231 @@ class DummyEvent:
         self.id = msg_id
 
 
-stored: Dict[EventUid, Dict[int, Message]] = {}
+class MessageStore:
+    """Map source messages to the ids of their copies in every destination.
+
+    Only the last `maxsize` messages are kept, the least recently used one is
+    evicted first.
+    """
+
+    def __init__(self, maxsize: int = KEEP_LAST_MANY) -> None:
+        self.maxsize = maxsize
+        self.data: "OrderedDict[EventUid, Dict[int, List[int]]]" = OrderedDict()
+
+    def __contains__(self, uid: EventUid) -> bool:
+        return uid in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(
+        self, uid: EventUid, default: Optional[Dict[int, List[int]]] = None
+    ) -> Optional[Dict[int, List[int]]]:
+        """Return the ids of the copies of a message, keyed by destination."""
+        copies = self.data.get(uid)
+        if copies is None:
+            return default
+        self.data.move_to_end(uid)
+        return copies
+
+    def add(self, uid: EventUid, dest: int, ids: List[int]) -> None:
+        """Remember the ids of the copies of a message in a destination."""
+        copies = self.data.get(uid)
+        if copies is None:
+            copies = self.data[uid] = {}
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        else:
+            self.data.move_to_end(uid)
+        copies[dest] = ids
+
+    def pop(self, uid: EventUid) -> Optional[Dict[int, List[int]]]:
+        return self.data.pop(uid, None)
+
+    def first_ids(self, uid: EventUid) -> Dict[int, int]:
+        """Return the id of the first copy of a message, keyed by destination."""
+        return {dest: ids[0] for dest, ids in self.get(uid, {}).items() if ids}
+
+
+class MessageMap:
+    """Persist the ids of copies in sqlite, so that syncs survive restarts.
+
+    The MessageStore is used as a hot cache in front of the database. New
+    mappings are written in batches, when enough of them are pending or every
+    few seconds, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        path: str = MESSAGE_MAP_FILE_NAME,
+        cache_size: int = KEEP_LAST_MANY,
+        batch: int = MESSAGE_MAP_BATCH,
+        interval: float = MESSAGE_MAP_INTERVAL,
+    ) -> None:
+        self.path = path
+        self.cache = MessageStore(cache_size)
+        self.batch = batch
+        self.interval = interval
+        self.pending: List[Tuple[int, int, int, int]] = []
+        self.conn: Optional[sqlite3.Connection] = None
+        self.task: Optional[asyncio.Task] = None
+        # ids of each chat that may have been copied since its last checkpoint
+        self.windows: Dict[int, Tuple[int, int]] = {}
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS copies (
+                    src_chat INTEGER, src_msg INTEGER,
+                    dest_chat INTEGER, dest_msg INTEGER,
+                    PRIMARY KEY (src_chat, src_msg, dest_chat, dest_msg)
+                ) WITHOUT ROWID"""
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS copies_dest ON copies (dest_chat, dest_msg)"
+            )
+        return self.conn
+
+    def __contains__(self, uid: EventUid) -> bool:
+        return self.get(uid) is not None
+
+    def get(
+        self, uid: EventUid, default: Optional[Dict[int, List[int]]] = None
+    ) -> Optional[Dict[int, List[int]]]:
+        """Return the ids of the copies of a message, keyed by destination."""
+        copies = self.cache.get(uid)
+        if copies is not None:
+            return copies
+        self.flush()
+        rows = self.db.execute(
+            "SELECT dest_chat, dest_msg FROM copies"
+            " WHERE src_chat = ? AND src_msg = ? ORDER BY dest_chat, dest_msg",
+            (uid.chat_id, uid.msg_id),
+        ).fetchall()
+        if not rows:
+            return default
+        for dest, dest_msg in rows:
+            copies = self.cache.get(uid) or {}
+            self.cache.add(uid, dest, copies.get(dest, []) + [dest_msg])
+        return self.cache.get(uid)
+
+    def add(self, uid: EventUid, dest: int, ids: List[int]) -> None:
+        """Remember the ids of the copies of a message in a destination."""
+        self.cache.add(uid, dest, ids)
+        self.pending.extend((uid.chat_id, uid.msg_id, dest, i) for i in ids)
+        if len(self.pending) >= self.batch:
+            self.flush()
+        elif self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except sqlite3.Error as err:
+                logging.error(f"Failed to write message map: {err}")
+
+    def flush(self) -> None:
+        """Write all pending mappings in one transaction."""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO copies VALUES (?, ?, ?, ?)", pending
+            )
+
+    def pop(self, uid: EventUid) -> Optional[Dict[int, List[int]]]:
+        """Forget a message and return the ids of its copies."""
+        return self.pop_many([uid])[0]
+
+    def pop_many(self, uids: List[EventUid]) -> List[Optional[Dict[int, List[int]]]]:
+        """Forget many messages at once and return the ids of their copies."""
+        copies = [self.get(uid) for uid in uids]
+        for uid in uids:
+            self.cache.pop(uid)
+        found = [(uid.chat_id, uid.msg_id) for uid, c in zip(uids, copies) if c]
+        if found:
+            with self.db:
+                self.db.executemany(
+                    "DELETE FROM copies WHERE src_chat = ? AND src_msg = ?", found
+                )
+        return copies
+
+    def first_ids(self, uid: EventUid) -> Dict[int, int]:
+        """Return the id of the first copy of a message, keyed by destination."""
+        return {dest: ids[0] for dest, ids in self.get(uid, {}).items() if ids}
+
+    def earlier_copies(self, uid: EventUid, offset: int) -> Dict[int, List[int]]:
+        """Return the copies of a message made by an earlier run, keyed by destination.
+
+        Checkpoints lag behind the sends, so after a crash the messages up to
+        CHECKPOINT_LAG ids above the offset may be copied already. The window
+        is set when a chat is first asked about, from the highest message of it
+        stored then. If that is further above the offset, the offset was moved
+        back to send the messages again, and none are looked up.
+        """
+        window = self.windows.get(uid.chat_id)
+        if window is None:
+            row = self.db.execute(
+                "SELECT MAX(src_msg) FROM copies WHERE src_chat = ?", (uid.chat_id,)
+            ).fetchone()
+            top = row[0] or 0
+            window = (offset, top) if top <= offset + CHECKPOINT_LAG else (0, 0)
+            self.windows[uid.chat_id] = window
+        if not window[0] < uid.msg_id <= window[1]:
+            return {}
+        return self.get(uid, {})
+
+    def source_of(self, dest: int, dest_msg: int) -> Optional[EventUid]:
+        """Return the original of a copy in a destination."""
+        self.flush()
+        row = self.db.execute(
+            "SELECT src_chat, src_msg FROM copies WHERE dest_chat = ? AND dest_msg = ?",
+            (dest, dest_msg),
+        ).fetchone()
+        if row is None:
+            return None
+        return EventUid(DummyEvent(*row))
+
+    def close(self) -> None:
+        """Write pending mappings and close the database."""
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self.flush()
+        self.windows.clear()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def remember(
+    originals: Iterable[Message], fwded_msgs: Dict[int, Message | List[Message]]
+) -> None:
+    """Store the copies made of the original messages in every destination.
+
+    An album is sent as a list of messages, each copy is matched with its
+    original by position.
+    """
+    originals = list(originals)
+    for dest, fwded in fwded_msgs.items():
+        if not fwded:
+            continue
+        ids = [msg.id for msg in fwded] if isinstance(fwded, list) else [fwded.id]
+        for i, original in enumerate(originals):
+            uid = EventUid(DummyEvent(original.chat_id, original.id))
+            if len(ids) == len(originals):
+                stored.add(uid, dest, [ids[i]])
+            else:
+                stored.add(uid, dest, ids)
+
+
+stored = MessageMap()
 CONFIG_TYPE: int = 0
 mycol: Collection = None
@@ -1,12 +1,24 @@
 """Utility functions to smoothen your life."""
 
+import asyncio
 import logging
 import os
 import platform
 import re
 import sys
-from datetime import datetime
-from typing import TYPE_CHECKING
+import time
+from contextlib import contextmanager
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 from telethon.client import TelegramClient
 from telethon.hints import EntityLike
@@ -14,6 +26,9 @@ from telethon.tl.custom.message import Message
 
 from tgcf import __version__
 from tgcf.config import CONFIG
+from tgcf.const import DELETE_CHUNK, SESSION_DIR
+from tgcf.limiter import limiter
+from tgcf.peers import peers
 from tgcf.plugin_models import STYLE_CODES
 
 if TYPE_CHECKING:
@@ -30,9 +45,31 @@ def platform_info():
 
 
 async def send_message(
-    agent_id: int, recipient: EntityLike, tm: "TgcfMessage"
+    agent_id: int,
+    recipient: EntityLike,
+    tm: "TgcfMessage",
+    reply_to: Optional[int] = None,
+) -> Message:
+    """Forward or send a copy, depending on config.
+
+    The request is paced by the rate limiter of the agent and recipient.
+    """
+    if reply_to is None:
+        reply_to = tm.reply_to
+    return await limiter.call(
+        agent_id,
+        recipient,
+        lambda: peers.call(
+            tm.client,
+            recipient,
+            lambda peer: _send_message(agent_id, peer, tm, reply_to),
+        ),
+    )
+
+
+async def _send_message(
+    agent_id: int, recipient: EntityLike, tm: "TgcfMessage", reply_to: Optional[int]
 ) -> Message:
-    """Forward or send a copy, depending on config."""
     client: TelegramClient = tm.client
     if CONFIG.agent_fwd_cfg[agent_id].show_forwarded_from:
         if tm.grouped_files:
@@ -40,38 +77,118 @@ async def send_message(
         else:
             return await client.forward_messages(recipient, tm.message)
     if tm.new_file:
+        handle, attributes = await tm.upload()
         message = await client.send_file(
-            recipient, tm.new_file, caption=tm.text, reply_to=tm.reply_to
+            recipient,
+            handle,
+            caption=tm.text,
+            reply_to=reply_to,
+            attributes=attributes,
         )
         return message
     
     if tm.grouped_files:
         logging.info(f"{len(tm.grouped_files)} files")
-        return await client.send_message(recipient, tm.text, reply_to=tm.reply_to, file=tm.grouped_files)
+        return await client.send_message(recipient, tm.text, reply_to=reply_to, file=tm.grouped_files)
     else:
         if tm.message:
             tm.message.text = tm.text
-            return await client.send_message(recipient, tm.message, reply_to=tm.reply_to)
+            return await client.send_message(recipient, tm.message, reply_to=reply_to)
+
+
+async def forward_messages(
+    agent_id: int,
+    client: TelegramClient,
+    recipient: EntityLike,
+    messages: List[Message],
+    drop_author: bool = False,
+) -> List[Message]:
+    """Forward many messages of one chat in a single request."""
+    return await limiter.call(
+        agent_id,
+        recipient,
+        lambda: peers.call(
+            client,
+            recipient,
+            lambda peer: client.forward_messages(
+                peer, messages, drop_author=drop_author or None
+            ),
+        ),
+    )
+
+
+async def edit_message(
+    agent_id: int, client: TelegramClient, recipient: EntityLike, msg_id: int, text: str
+) -> Message:
+    """Edit the text of a message sent earlier."""
+    return await limiter.call(
+        agent_id,
+        recipient,
+        lambda: peers.call(
+            client, recipient, lambda peer: client.edit_message(peer, msg_id, text)
+        ),
+    )
+
+
+async def delete_messages(
+    agent_id: int, client: TelegramClient, recipient: EntityLike, msg_ids: List[int]
+) -> None:
+    """Delete messages sent earlier, in requests of at most DELETE_CHUNK ids."""
+    for i in range(0, len(msg_ids), DELETE_CHUNK):
+        chunk = msg_ids[i : i + DELETE_CHUNK]
+        await limiter.call(
+            agent_id,
+            recipient,
+            lambda: peers.call(
+                client, recipient, lambda peer: client.delete_messages(peer, chunk)
+            ),
+        )
 
 
-def cleanup(*files: str) -> None:
-    """Delete the file names passed as args."""
-    for file in files:
-        try:
-            os.remove(file)
-        except FileNotFoundError:
-            logging.info(f"File {file} does not exist, so cant delete it.")
+async def fan_out(
+    agent_id: int, dest: List[int], func: Callable[[int], Awaitable[Any]]
+) -> Tuple[Dict[int, Any], Dict[int, Exception]]:
+    """Call func for all destinations at the same time.
+
+    At most `max_parallel_sends` destinations are handled at once. Callers await
+    this before handling the next message, so each destination keeps the order.
+
+    Returns:
+        Tuple: the results and the errors, both keyed by destination
+    """
+    limit = asyncio.Semaphore(CONFIG.agent_fwd_cfg[agent_id].max_parallel_sends)
+
+    async def _call(d: int) -> Any:
+        async with limit:
+            return await func(d)
+
+    results = await asyncio.gather(*(_call(d) for d in dest), return_exceptions=True)
+    done: Dict[int, Any] = {}
+    failed: Dict[int, Exception] = {}
+    for d, result in zip(dest, results):
+        if isinstance(result, Exception):
+            logging.error(f"Failed to reach {d}: {result}")
+            failed[d] = result
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            done[d] = result
+    return done, failed
 
 
-def stamp(file: str, user: str) -> str:
-    """Stamp the filename with the datetime, and user info."""
-    now = str(datetime.now())
-    outf = safe_name(f"{user} {now} {file}")
-    try:
-        os.rename(file, outf)
-        return outf
-    except Exception as err:
-        logging.warning(f"Stamping file name failed for {file} to {outf}. \n {err}")
+async def send_to_all(
+    agent_id: int,
+    dest: List[int],
+    tm: "TgcfMessage",
+    reply_to: Optional[Dict[int, int]] = None,
+) -> Tuple[Dict[int, Message], Dict[int, Exception]]:
+    """Send the message to all destinations at the same time, see fan_out."""
+    reply_to = reply_to or {}
+    return await fan_out(
+        agent_id,
+        dest,
+        lambda d: send_message(agent_id, d, tm, reply_to=reply_to.get(d)),
+    )
 
 
 def safe_name(string: str) -> str:
@@ -104,6 +221,18 @@ def replace(pattern: str, new: str, string: str, regex: bool) -> str:
 
 
 def clean_session_files():
-    for item in os.listdir():
-        if item.endswith(".session") or item.endswith(".session-journal"):
-            os.remove(item)
+    """Remove the session files of all agents, forcing them to log in again."""
+    for folder in (".", SESSION_DIR):
+        if not os.path.isdir(folder):
+            continue
+        for item in os.listdir(folder):
+            if item.endswith(".session") or item.endswith(".session-journal"):
+                os.remove(os.path.join(folder, item))
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """Log how long the phase inside the block took."""
+    start = time.perf_counter()
+    yield
+    logging.info(f"{phase} took {time.perf_counter() - start:.2f}s")
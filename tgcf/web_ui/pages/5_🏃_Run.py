@@ -12,10 +12,21 @@ from tgcf.web_ui.utils import hide_st, switch_theme
 CONFIG = read_config()
 
 
+def log_owner(agent_id: int) -> int:
+    """Return the agent whose log file an agent writes to.
+
+    Agents run together in one process write to the log of the first of them.
+    """
+    pid = CONFIG.agent_fwd_cfg[agent_id].pid
+    if pid == 0:
+        return agent_id
+    return next(j for j, fc in enumerate(CONFIG.agent_fwd_cfg) if fc.pid == pid)
+
+
 def termination(agent_id:int):
     st.code("process terminated!")
     try:
-        os.rename(f"logs_{i}.txt", f"old_logs_{i}.txt")
+        os.rename(f"logs_{log_owner(i)}.txt", f"old_logs_{i}.txt")
         with open("old_logs.txt", "r") as f:
             st.download_button(
                 "Download last logs", data=f.read(), file_name=f"tgcf_logs_{i}.txt"
@@ -24,7 +35,11 @@ def termination(agent_id:int):
         print("error on rename log")
 
     CONFIG = read_config()
-    CONFIG.agent_fwd_cfg[i].pid= 0
+    pid = CONFIG.agent_fwd_cfg[i].pid
+    # the agents run together with it stopped too
+    for agent_fc in CONFIG.agent_fwd_cfg:
+        if agent_fc.pid == pid:
+            agent_fc.pid = 0
     write_config(CONFIG)
     st.button("Refresh page")
 
@@ -64,6 +79,24 @@ if check_password(st):
                     value=agent_fc.show_forwarded_from,
                     key=f"sff {i}",
                 )
+                agent_fc.max_parallel_sends = st.number_input(
+                    "Destinations to send to at the same time",
+                    min_value=1,
+                    value=agent_fc.max_parallel_sends,
+                    key=f"parallel {i}",
+                )
+                agent_fc.rate_limit = st.number_input(
+                    "Messages per second to one destination",
+                    min_value=0.01,
+                    value=agent_fc.rate_limit,
+                    key=f"rate {i}",
+                )
+                agent_fc.burst = st.number_input(
+                    "Messages to one destination allowed back to back",
+                    min_value=1,
+                    value=agent_fc.burst,
+                    key=f"burst {i}",
+                )
                 mode = st.radio(
                     "Choose mode",
                     ["live", "past", "both"],
@@ -82,6 +115,18 @@ if check_password(st):
                         value=agent_fc.past.delay,
                         key=f"delay {i}",
                     )
+                    agent_fc.past.concurrency = st.number_input(
+                        "Sources to go through at the same time",
+                        min_value=1,
+                        value=agent_fc.past.concurrency,
+                        key=f"concurrency {i}",
+                    )
+                    agent_fc.past.plugin_workers = st.number_input(
+                        "Messages of a source to apply plugins to at the same time",
+                        min_value=1,
+                        value=agent_fc.past.plugin_workers,
+                        key=f"plugin workers {i}",
+                    )
                 elif mode == "both":
                     agent_fc.mode = 2
                     agent_fc.live.delete_sync = st.checkbox(
@@ -89,6 +134,14 @@ if check_password(st):
                         value=agent_fc.live.delete_sync,
                         key=f"del sync {i}",
                     )
+                    agent_fc.live.edit_sync = st.checkbox(
+                        "Sync when a message is edited",
+                        value=agent_fc.live.edit_sync,
+                        key=f"edit sync {i}",
+                        disabled=agent_fc.show_forwarded_from,
+                        help="Forwarded messages can not be edited, so edits are"
+                        " not synced when 'Forwarded from' is shown.",
+                    )
                     st.warning(
                         "Only User Account can be used in Past mode. Telegram does not allow bot account to go through history of a chat!"
                     )
@@ -99,6 +152,18 @@ if check_password(st):
                         value=agent_fc.past.delay,
                         key=f"delay {i}",
                     )
+                    agent_fc.past.concurrency = st.number_input(
+                        "Sources to go through at the same time",
+                        min_value=1,
+                        value=agent_fc.past.concurrency,
+                        key=f"concurrency {i}",
+                    )
+                    agent_fc.past.plugin_workers = st.number_input(
+                        "Messages of a source to apply plugins to at the same time",
+                        min_value=1,
+                        value=agent_fc.past.plugin_workers,
+                        key=f"plugin workers {i}",
+                    )
                 else:
                     agent_fc.mode = 0
                     agent_fc.live.delete_sync = st.checkbox(
@@ -106,6 +171,14 @@ if check_password(st):
                         value=agent_fc.live.delete_sync,
                         key=f"del sync {i}",
                     )
+                    agent_fc.live.edit_sync = st.checkbox(
+                        "Sync when a message is edited",
+                        value=agent_fc.live.edit_sync,
+                        key=f"edit sync {i}",
+                        disabled=agent_fc.show_forwarded_from,
+                        help="Forwarded messages can not be edited, so edits are"
+                        " not synced when 'Forwarded from' is shown.",
+                    )
                 if st.button("Save ", key=f"save {i}"):
                     write_config(CONFIG)
 
@@ -118,6 +191,17 @@ if check_password(st):
                 st.warning(
                     "You must click stop and then re-run tgcf to apply changes in config."
                 )
+                together = [
+                    tab_strs[j]
+                    for j in range(num)
+                    if j != i
+                    and CONFIG.agent_fwd_cfg[j].pid == CONFIG.agent_fwd_cfg[i].pid
+                ]
+                if together:
+                    st.info(
+                        f"Runs in one process with {', '.join(together)},"
+                        " stopping it stops them too."
+                    )
                 # check if process is running using pid
                 try:
                     os.kill(CONFIG.agent_fwd_cfg[i].pid, signal.SIGCONT)
@@ -165,13 +249,46 @@ if check_password(st):
                     key=f"slider {i}",
                 )
                 temp_logs = f"logs_n_lines{i}.txt"
+                log_file = f"logs_{log_owner(i)}.txt"
                 os.system(f"rm {temp_logs}")
-                with open(f"logs_{i}.txt", "r") as file:
+                with open(log_file, "r") as file:
                     pass
 
-                os.system(f"tail -n {lines} logs_{i}.txt >> {temp_logs}")
+                os.system(f"tail -n {lines} {log_file} >> {temp_logs}")
                 with open(temp_logs, "r") as file:
                     st.code(file.read())
             except FileNotFoundError as err:
                 st.write("No present logs found")
             st.button(f"Load more logs for {agent.alias}")
+
+    st.subheader("Run agents together")
+    st.write(
+        "The agents share one process, which uses much less memory than one"
+        " process for each. Every agent runs in the mode chosen for it above."
+    )
+    idle = [i for i in range(num) if CONFIG.agent_fwd_cfg[i].pid == 0]
+    chosen = st.multiselect(
+        "Agents",
+        idle,
+        default=idle,
+        format_func=lambda i: tab_strs[i],
+        key="multi agents",
+    )
+    if st.button("Run together", type="primary", disabled=not chosen):
+        # the agents read their modes from the config
+        write_config(CONFIG)
+        command = ["tgcf", "--loud", "multi"]
+        for i in chosen:
+            command += ["--agent", str(i)]
+        with open(f"logs_{min(chosen)}.txt", "w") as logs:
+            process = subprocess.Popen(
+                command,
+                stdout=logs,
+                stderr=subprocess.STDOUT,
+            )
+        for i in chosen:
+            CONFIG.agent_fwd_cfg[i].pid = process.pid
+        write_config(CONFIG)
+        time.sleep(2)
+
+        st.rerun()
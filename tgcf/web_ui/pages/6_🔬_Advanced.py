@@ -61,6 +61,46 @@ if check_password(st):
                     st.write(
                         "When you edit the message in source to something particular, the message will be deleted in both source and destinations."
                     )
+
+                    agent.live.queue_size = st.number_input(
+                        "Max pending messages per source chat",
+                        min_value=1,
+                        value=agent.live.queue_size,
+                        key=f"queuesize {i}",
+                    )
+                    st.write(
+                        "Every source chat is forwarded by its own worker. When a worker falls this far behind, the policy below applies."
+                    )
+
+                    policies = ["block", "drop_oldest", "spill"]
+                    agent.live.overflow = st.selectbox(
+                        "When a source chat has too many pending messages",
+                        policies,
+                        index=policies.index(agent.live.overflow),
+                        format_func=lambda p: {
+                            "block": "Wait for a free slot",
+                            "drop_oldest": "Drop the oldest pending message",
+                            "spill": "Save new messages to disk and send them later",
+                        }[p],
+                        key=f"overflow {i}",
+                    )
+
+                    agent.live.album_wait = st.number_input(
+                        "Seconds to wait for the rest of an album",
+                        min_value=0.1,
+                        value=agent.live.album_wait,
+                        key=f"albumwait {i}",
+                    )
+
+                    agent.live.edit_wait = st.number_input(
+                        "Seconds to collect edits of a message before syncing",
+                        min_value=0.0,
+                        value=agent.live.edit_wait,
+                        key=f"editwait {i}",
+                    )
+                    st.write(
+                        "When a message is edited many times in a row, only its last text within this window is sent to the destinations."
+                    )
         with st.expander("Customize bot messages"):
             st.info(
                 "Note: For userbots, the commands start with `.` instead of `/`, like `.start` and not `/start`"